@@ -2,6 +2,7 @@
 # Face Recognition Attendance System - Main Application
 
 import cv2
+import dlib
 import face_recognition
 import numpy as np
 import sqlite3
@@ -11,10 +12,16 @@ from datetime import datetime, timedelta
 import os
 import pickle
 import json
+import tempfile
 from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, Response
 from werkzeug.utils import secure_filename
 import threading
 import time
+import queue
+import atexit
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
 
 # --- Database Management Class ---
@@ -60,41 +67,233 @@ class DatabaseManager:
                     FOREIGN KEY (employee_id) REFERENCES employees (employee_id)
                 )
             ''')
+
+            # Create face templates table; employees.face_encoding stays the primary template
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS face_templates (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    employee_id TEXT NOT NULL,
+                    face_encoding TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (employee_id) REFERENCES employees (employee_id)
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_face_templates_employee ON face_templates (employee_id)')
+
+            # Pairs of employees whose faces look like the same person, stored
+            # once with the smaller employee_id first (see add_duplicate_flags)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS duplicate_flags (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    employee_id TEXT NOT NULL,
+                    duplicate_of TEXT NOT NULL,
+                    distance REAL NOT NULL,
+                    source TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE (employee_id, duplicate_of)
+                )
+            ''')
+
+            # Columns added after the tables were first created:
+            # site scopes camera galleries; encoding_version records what
+            # produced an encoding; source_image is the compressed enrollment
+            # photo; pending_* stage the results of a re-encoding job.
+            self.add_missing_columns(conn, 'employees', {'site': 'TEXT', 'encoding_version': 'TEXT'})
+            self.add_missing_columns(conn, 'face_templates', {
+                'encoding_version': 'TEXT',
+                'source_image': 'BLOB',
+                'pending_encoding': 'TEXT',
+                'pending_version': 'TEXT',
+            })
+
+            # Fold duplicate flags stored in both orientations into one row
+            conn.execute('''
+                DELETE FROM duplicate_flags
+                WHERE employee_id > duplicate_of AND EXISTS (
+                    SELECT 1 FROM duplicate_flags other
+                    WHERE other.employee_id = duplicate_flags.duplicate_of
+                      AND other.duplicate_of = duplicate_flags.employee_id)
+            ''')
+            conn.execute('''
+                UPDATE duplicate_flags SET employee_id = duplicate_of, duplicate_of = employee_id
+                WHERE employee_id > duplicate_of
+            ''')
+
+            # Backfill a template for employees enrolled before templates existed
+            conn.execute('''
+                INSERT INTO face_templates (employee_id, face_encoding, encoding_version)
+                SELECT employee_id, face_encoding, encoding_version FROM employees
+                WHERE employee_id NOT IN (SELECT employee_id FROM face_templates)
+            ''')
             conn.commit()
+
+    @staticmethod
+    def add_missing_columns(conn, table, columns):
+        existing = [row['name'] for row in conn.execute(f'PRAGMA table_info({table})')]
+        for name, column_type in columns.items():
+            if name not in existing:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
     
-    def add_employee(self, employee_id, name, email, department, face_encoding):
+    def _insert_face_templates(self, conn, employee_id, templates, encoding_version):
+        conn.executemany('''
+            INSERT INTO face_templates (employee_id, face_encoding, encoding_version, source_image)
+            VALUES (?, ?, ?, ?)
+        ''', [(employee_id, json.dumps(face_encoding.tolist()), encoding_version, source_image)
+              for face_encoding, source_image in templates])
+
+    def add_employee(self, employee_id, name, email, department, face_encoding, site=None, encoding_version=None,
+                     source_image=None, extra_templates=()):
+        # extra_templates, as (face_encoding, source_image), are stored in the
+        # same transaction so the employee never exists with only some of them.
         with self.get_db_connection() as conn:
             try:
-                encoding_str = json.dumps(face_encoding.tolist())
                 conn.execute('''
-                    INSERT INTO employees (employee_id, name, email, department, face_encoding)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (employee_id, name, email, department, encoding_str))
+                    INSERT INTO employees (employee_id, name, email, department, face_encoding, site, encoding_version)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (employee_id, name, email, department, json.dumps(face_encoding.tolist()), site or None,
+                      encoding_version))
+                self._insert_face_templates(conn, employee_id, [(face_encoding, source_image)] + list(extra_templates),
+                                            encoding_version)
                 conn.commit()
                 return True
             except sqlite3.IntegrityError:
                 return False
+
+    def add_face_template(self, employee_id, face_encoding, encoding_version=None, source_image=None):
+        return self.add_face_templates(employee_id, [(face_encoding, source_image)], encoding_version)
+
+    def add_face_templates(self, employee_id, templates, encoding_version=None):
+        # All (face_encoding, source_image) pairs or none of them.
+        with self.get_db_connection() as conn:
+            cursor = conn.execute('SELECT 1 FROM employees WHERE employee_id = ?', (employee_id,))
+            if cursor.fetchone() is None:
+                return False
+            self._insert_face_templates(conn, employee_id, templates, encoding_version)
+            conn.commit()
+            return True
+
+    def get_encoding_versions(self):
+        with self.get_db_connection() as conn:
+            cursor = conn.execute('''
+                SELECT COALESCE(encoding_version, 'unknown') AS version, COUNT(*) AS templates,
+                       SUM(source_image IS NOT NULL) AS with_source
+                FROM face_templates GROUP BY encoding_version
+            ''')
+            return {row['version']: {'templates': row['templates'], 'with_source': row['with_source']}
+                    for row in cursor.fetchall()}
+
+    def get_reencode_candidates(self, version):
+        # Templates not yet at version and not already re-encoded for it by an earlier, interrupted run.
+        with self.get_db_connection() as conn:
+            cursor = conn.execute('''
+                SELECT id FROM face_templates
+                WHERE source_image IS NOT NULL
+                  AND encoding_version IS NOT ? AND pending_version IS NOT ?
+                ORDER BY id
+            ''', (version, version))
+            return [row['id'] for row in cursor.fetchall()]
+
+    def count_stale_without_source(self, version):
+        with self.get_db_connection() as conn:
+            cursor = conn.execute('''
+                SELECT COUNT(*) AS stale FROM face_templates
+                WHERE source_image IS NULL AND encoding_version IS NOT ?
+            ''', (version,))
+            return cursor.fetchone()['stale']
+
+    def get_template_images(self, template_ids):
+        with self.get_db_connection() as conn:
+            placeholders = ','.join('?' * len(template_ids))
+            cursor = conn.execute(f'SELECT id, source_image FROM face_templates WHERE id IN ({placeholders})',
+                                  list(template_ids))
+            return [(row['id'], row['source_image']) for row in cursor.fetchall()]
+
+    def save_pending_encodings(self, results, version):
+        # results: (template_id, encoding or None); failures are staged as NULL
+        # so a resumed run skips them and the swap keeps their old encoding.
+        with self.get_db_connection() as conn:
+            conn.executemany('UPDATE face_templates SET pending_encoding = ?, pending_version = ? WHERE id = ?', [
+                (json.dumps(encoding.tolist()) if encoding is not None else None, version, template_id)
+                for template_id, encoding in results
+            ])
+            conn.commit()
+
+    def apply_pending_encodings(self, version):
+        # Swaps every staged encoding in at once; returns how many were applied.
+        with self.get_db_connection() as conn:
+            cursor = conn.execute('''
+                UPDATE face_templates SET face_encoding = pending_encoding, encoding_version = pending_version
+                WHERE pending_version = ? AND pending_encoding IS NOT NULL
+            ''', (version,))
+            applied = cursor.rowcount
+            conn.execute('UPDATE face_templates SET pending_encoding = NULL, pending_version = NULL WHERE pending_version = ?',
+                         (version,))
+            # Keep each employee's primary encoding in step with their first template.
+            conn.execute('''
+                UPDATE employees SET
+                    face_encoding = (SELECT t.face_encoding FROM face_templates t
+                                     WHERE t.employee_id = employees.employee_id ORDER BY t.id LIMIT 1),
+                    encoding_version = (SELECT t.encoding_version FROM face_templates t
+                                        WHERE t.employee_id = employees.employee_id ORDER BY t.id LIMIT 1)
+                WHERE employee_id IN (SELECT employee_id FROM face_templates)
+            ''')
+            conn.commit()
+            return applied
     
     def get_all_employees(self):
         with self.get_db_connection() as conn:
             cursor = conn.execute('SELECT * FROM employees ORDER BY name')
             return cursor.fetchall()
     
-    def get_employee_encodings(self):
+    def add_duplicate_flags(self, pairs, source):
+        # pairs: (employee_id, duplicate_of, distance) in either order; each
+        # pair is stored smaller id first, so re-flagging it updates one row.
         with self.get_db_connection() as conn:
-            cursor = conn.execute('SELECT employee_id, name, face_encoding FROM employees')
-            employees = cursor.fetchall()
-            
-            encodings = []
+            conn.executemany('''
+                INSERT INTO duplicate_flags (employee_id, duplicate_of, distance, source)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (employee_id, duplicate_of) DO UPDATE SET distance = excluded.distance, source = excluded.source
+            ''', [(min(employee_id, duplicate_of), max(employee_id, duplicate_of), float(distance), source)
+                  for employee_id, duplicate_of, distance in pairs])
+            conn.commit()
+
+    def get_duplicate_flags(self):
+        with self.get_db_connection() as conn:
+            cursor = conn.execute('''
+                SELECT d.employee_id, a.name, d.duplicate_of, b.name AS duplicate_name, d.distance, d.source, d.created_at
+                FROM duplicate_flags d
+                JOIN employees a ON d.employee_id = a.employee_id
+                JOIN employees b ON d.duplicate_of = b.employee_id
+                ORDER BY d.distance
+            ''')
+            return cursor.fetchall()
+
+    def get_employee_scopes(self):
+        with self.get_db_connection() as conn:
+            cursor = conn.execute('SELECT employee_id, department, site FROM employees')
+            return {row['employee_id']: (row['department'], row['site']) for row in cursor.fetchall()}
+
+    def get_face_templates(self):
+        # One row per template, grouped by employee so the matcher can
+        # reduce each employee's templates over a contiguous slice.
+        with self.get_db_connection() as conn:
+            cursor = conn.execute('''
+                SELECT t.employee_id, e.name, t.face_encoding
+                FROM face_templates t
+                JOIN employees e ON t.employee_id = e.employee_id
+                ORDER BY t.employee_id, t.id
+            ''')
+            templates = cursor.fetchall()
+
+            # Filled straight into one float32 matrix rather than a list of
+            # per-employee float64 arrays.
+            encodings = np.empty((len(templates), FaceMatcher.ENCODING_SIZE), dtype=np.float32)
             names = []
             employee_ids = []
-            
-            for emp in employees:
-                encoding = np.array(json.loads(emp['face_encoding']))
-                encodings.append(encoding)
-                names.append(emp['name'])
-                employee_ids.append(emp['employee_id'])
-            
+            for index, row in enumerate(templates):
+                encodings[index] = json.loads(row['face_encoding'])
+                names.append(row['name'])
+                employee_ids.append(row['employee_id'])
             return encodings, names, employee_ids
     
     def mark_attendance(self, employee_id, attendance_type='check_in'):
@@ -132,136 +331,2444 @@ class DatabaseManager:
             ''', (start_date,))
             return cursor.fetchall()
 
-    def get_attendance_summary(self):
-        with self.get_db_connection() as conn:
-            today = datetime.now().date()
-            
-            cursor = conn.execute('SELECT COUNT(*) as present_today FROM attendance WHERE date = ? AND check_in_time IS NOT NULL', (today,))
-            present_today = cursor.fetchone()['present_today']
-            
-            cursor = conn.execute('SELECT COUNT(*) as total FROM employees')
-            total_employees = cursor.fetchone()['total']
-            
-            week_start = today - timedelta(days=7)
-            cursor = conn.execute('''
-                SELECT AVG(daily_count) as avg_attendance
-                FROM (
-                    SELECT DATE(date) as day, COUNT(*) as daily_count
-                    FROM attendance 
-                    WHERE date >= ? AND check_in_time IS NOT NULL
-                    GROUP BY DATE(date)
-                )
-            ''', (week_start,))
-            avg_result = cursor.fetchone()
-            avg_attendance = round(avg_result['avg_attendance'] or 0, 1)
-            
-            return {
-                'present_today': present_today,
-                'total_employees': total_employees,
-                'absent_today': total_employees - present_today,
-                'avg_attendance': avg_attendance
-            }
+    def get_attendance_summary(self):
+        with self.get_db_connection() as conn:
+            today = datetime.now().date()
+            
+            cursor = conn.execute('SELECT COUNT(*) as present_today FROM attendance WHERE date = ? AND check_in_time IS NOT NULL', (today,))
+            present_today = cursor.fetchone()['present_today']
+            
+            cursor = conn.execute('SELECT COUNT(*) as total FROM employees')
+            total_employees = cursor.fetchone()['total']
+            
+            week_start = today - timedelta(days=7)
+            cursor = conn.execute('''
+                SELECT AVG(daily_count) as avg_attendance
+                FROM (
+                    SELECT DATE(date) as day, COUNT(*) as daily_count
+                    FROM attendance 
+                    WHERE date >= ? AND check_in_time IS NOT NULL
+                    GROUP BY DATE(date)
+                )
+            ''', (week_start,))
+            avg_result = cursor.fetchone()
+            avg_attendance = round(avg_result['avg_attendance'] or 0, 1)
+            
+            return {
+                'present_today': present_today,
+                'total_employees': total_employees,
+                'absent_today': total_employees - present_today,
+                'avg_attendance': avg_attendance
+            }
+
+# --- Face Landmark and Encoding Helpers ---
+# face_recognition.face_encodings() always recomputes landmarks internally, so
+# these helpers go one level down to compute them once and reuse them for the
+# quality gate, the encoder and overlay drawing.
+LANDMARK_SLICES = {
+    'large': {
+        'chin': list(range(0, 17)),
+        'left_eyebrow': list(range(17, 22)),
+        'right_eyebrow': list(range(22, 27)),
+        'nose_bridge': list(range(27, 31)),
+        'nose_tip': list(range(31, 36)),
+        'left_eye': list(range(36, 42)),
+        'right_eye': list(range(42, 48)),
+        'top_lip': list(range(48, 55)) + [64, 63, 62, 61, 60],
+        'bottom_lip': list(range(54, 60)) + [48, 60, 67, 66, 65, 64],
+    },
+    'small': {
+        'nose_tip': [4],
+        'left_eye': [2, 3],
+        'right_eye': [0, 1],
+    },
+}
+
+
+def compute_raw_landmarks(rgb_image, face_locations, model='small'):
+    return face_recognition.api._raw_face_landmarks(rgb_image, face_locations, model)
+
+
+def landmarks_to_dict(raw_landmarks, model='small'):
+    points = [(p.x, p.y) for p in raw_landmarks.parts()]
+    return {feature: [points[i] for i in indexes] for feature, indexes in LANDMARK_SLICES[model].items()}
+
+
+def encode_faces(rgb_image, raw_landmarks, num_jitters=1):
+    return [np.array(face_recognition.api.face_encoder.compute_face_descriptor(rgb_image, landmarks, num_jitters))
+            for landmarks in raw_landmarks]
+
+def compress_enrollment_image(rgb_image, max_side=640, quality=85):
+    # JPEG bytes of the enrollment photo, downscaled so its longer side is at most max_side.
+    height, width = rgb_image.shape[:2]
+    scale = min(1.0, max_side / float(max(height, width)))
+    if scale < 1.0:
+        rgb_image = cv2.resize(rgb_image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode('.jpg', cv2.cvtColor(rgb_image, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes() if ok else None
+
+# --- Batched Encoding Service Class ---
+class EncodingService:
+    """Encodes face chips from every camera pipeline in shared batches.
+
+    Callers cut aligned 150x150 chips on their own thread and block on a
+    future; a single worker thread gathers chips for at most max_wait_ms
+    after the oldest pending request (or until max_batch chips) and runs
+    them through dlib's descriptor network in one call.
+    """
+
+    CHIP_SIZE = 150
+    CHIP_PADDING = 0.25
+
+    def __init__(self, max_batch=32, max_wait_ms=5.0):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.requests = queue.Queue()
+        self.worker = None
+        self.stats = {'batches': 0, 'faces': 0, 'requests': 0}
+        self.lock = threading.Lock()
+
+    def _ensure_worker(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, name='encoding-service', daemon=True)
+                self.worker.start()
+
+    def encode(self, rgb_image, raw_landmarks, num_jitters=1):
+        if not raw_landmarks:
+            return []
+        chips = [dlib.get_face_chip(rgb_image, landmarks, size=self.CHIP_SIZE, padding=self.CHIP_PADDING)
+                 for landmarks in raw_landmarks]
+        future = Future()
+        self._ensure_worker()
+        self.requests.put((time.monotonic(), chips, num_jitters, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            first = self.requests.get()
+            batch = [first]
+            chip_count = len(first[1])
+            deadline = first[0] + self.max_wait
+            while chip_count < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                chip_count += len(item[1])
+            self._encode_batch(batch)
+
+    def _encode_batch(self, batch):
+        # Jitter count is a per-call argument to dlib, so group by it.
+        groups = {}
+        for item in batch:
+            groups.setdefault(item[2], []).append(item)
+
+        for num_jitters, items in groups.items():
+            chips = [chip for item in items for chip in item[1]]
+            try:
+                descriptors = face_recognition.api.face_encoder.compute_face_descriptor(chips, num_jitters)
+            except Exception as e:
+                for item in items:
+                    item[3].set_exception(e)
+                continue
+
+            offset = 0
+            for item in items:
+                count = len(item[1])
+                item[3].set_result([np.array(d) for d in descriptors[offset:offset + count]])
+                offset += count
+
+        with self.lock:
+            self.stats['batches'] += len(groups)
+            self.stats['requests'] += len(batch)
+            self.stats['faces'] += sum(len(item[1]) for item in batch)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['avg_batch_faces'] = round(stats['faces'] / float(stats['batches']), 2) if stats['batches'] else 0.0
+        stats['pending'] = self.requests.qsize()
+        return stats
+
+# --- Face Quality Gate Class ---
+class FaceQualityGate:
+    """Drops faces that are too small, too blurry or too far from frontal
+    before the expensive encoding step."""
+
+    def __init__(self, min_face_ratio=0.06, min_face_pixels=40, min_blur_score=50.0, max_yaw_ratio=0.35):
+        self.min_face_ratio = min_face_ratio
+        self.min_face_pixels = min_face_pixels
+        self.min_blur_score = min_blur_score
+        self.max_yaw_ratio = max_yaw_ratio
+        self.stats = {'checked': 0, 'passed': 0, 'too_small': 0, 'blurry': 0, 'not_frontal': 0}
+        self.lock = threading.Lock()
+
+    def is_large_enough(self, location, frame_height):
+        top, right, bottom, left = location
+        face_height = bottom - top
+        face_width = right - left
+        if min(face_height, face_width) < self.min_face_pixels:
+            return False
+        return face_height >= self.min_face_ratio * frame_height
+
+    def blur_score(self, rgb_frame, location):
+        top, right, bottom, left = location
+        height, width = rgb_frame.shape[:2]
+        crop = rgb_frame[max(top, 0):min(bottom, height), max(left, 0):min(right, width)]
+        if crop.size == 0:
+            return 0.0
+        gray = cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY)
+        return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+    @staticmethod
+    def yaw_ratio(landmarks):
+        # The nose tip sits roughly midway between the eyes on a frontal
+        # face and drifts towards one eye as the head turns. None when the
+        # eyes overlap.
+        left_eye = np.mean(landmarks['left_eye'], axis=0)
+        right_eye = np.mean(landmarks['right_eye'], axis=0)
+        nose_x = np.mean(landmarks['nose_tip'], axis=0)[0]
+        eye_distance = abs(right_eye[0] - left_eye[0])
+        if eye_distance == 0:
+            return None
+        return (nose_x - (left_eye[0] + right_eye[0]) / 2.0) / eye_distance
+
+    def is_frontal(self, landmarks):
+        yaw = self.yaw_ratio(landmarks)
+        return yaw is not None and abs(yaw) <= self.max_yaw_ratio
+
+    def filter(self, rgb_frame, face_locations, landmark_model='small'):
+        # Returns the surviving locations with their raw landmarks so the
+        # encoder can reuse them, plus the number of faces dropped.
+        frame_height = rgb_frame.shape[0]
+        rejected = {'too_small': 0, 'blurry': 0, 'not_frontal': 0}
+
+        candidates = []
+        for location in face_locations:
+            if not self.is_large_enough(location, frame_height):
+                rejected['too_small'] += 1
+            elif self.blur_score(rgb_frame, location) < self.min_blur_score:
+                rejected['blurry'] += 1
+            else:
+                candidates.append(location)
+
+        passed = []
+        passed_landmarks = []
+        if candidates:
+            for location, raw_landmarks in zip(candidates, compute_raw_landmarks(rgb_frame, candidates, landmark_model)):
+                if self.is_frontal(landmarks_to_dict(raw_landmarks, landmark_model)):
+                    passed.append(location)
+                    passed_landmarks.append(raw_landmarks)
+                else:
+                    rejected['not_frontal'] += 1
+
+        with self.lock:
+            self.stats['checked'] += len(face_locations)
+            self.stats['passed'] += len(passed)
+            for reason, count in rejected.items():
+                self.stats[reason] += count
+
+        return passed, passed_landmarks, len(face_locations) - len(passed)
+
+    def merge_stats(self, counts):
+        # Folds in counts gathered by a copy of the gate in a worker process.
+        with self.lock:
+            for key, count in counts.items():
+                self.stats[key] += count
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['filtered'] = stats['checked'] - stats['passed']
+        return stats
+
+# --- Adaptive Resolution Controller Class ---
+class AdaptiveResolutionController:
+    """Picks the detection resolution for one camera.
+
+    "adaptive" mode sizes the frame so the smallest face seen recently is just
+    large enough for HOG; "budget" mode scales it to hit a CPU time per frame.
+    Resolutions are tracked as an effective width (width * 2 ** upsample) so
+    the controller can trade resizing against HOG upsampling. In adaptive mode
+    every probe_interval-th frame is searched at search_width even while faces
+    are tracked, so a smaller face entering the scene is still found.
+    """
+
+    HOG_WINDOW_PIXELS = 80  # smallest face dlib's HOG detector finds without upsampling
+
+    def __init__(self, mode='adaptive', min_width=320, max_width=1024, search_width=None,
+                 target_face_pixels=100, budget_ms=80.0, idle_frames=30, smoothing=0.2, probe_interval=30):
+        self.mode = mode
+        self.min_width = min_width
+        self.max_width = max_width
+        self.search_width = search_width or 2 * max_width
+        self.probe_interval = probe_interval
+        self.target_face_pixels = target_face_pixels
+        self.budget_ms = budget_ms
+        self.idle_frames = idle_frames
+        self.smoothing = smoothing
+        self.effective_width = float(self.search_width)
+        self.face_ratio = None
+        self.frame_ms = None
+        self.frames_without_faces = 0
+        self.frames_since_probe = 0
+        self.frame_width = None
+        self.lock = threading.Lock()
+
+    def _smooth(self, previous, value):
+        if previous is None:
+            return value
+        return previous + self.smoothing * (value - previous)
+
+    def plan(self, frame_width, effective=None):
+        if effective is None:
+            with self.lock:
+                effective = self.effective_width
+        effective = max(self.min_width, min(effective, 2 * self.max_width, 2 * frame_width))
+        native_limit = min(self.max_width, frame_width)
+        if effective <= native_limit:
+            return int(effective) // 32 * 32, 0
+        return int(min(max(effective / 2, self.min_width), native_limit)), 1
+
+    def next_plan(self, frame_width):
+        # plan() for the next frame, plus whether that frame is a re-probe at
+        # search_width; pass the flag back to observe().
+        with self.lock:
+            self.frames_since_probe += 1
+            probe = (self.mode == 'adaptive' and bool(self.probe_interval) and
+                     self.frames_since_probe >= self.probe_interval and self.effective_width < self.search_width)
+            if probe:
+                self.frames_since_probe = 0
+            effective = self.search_width if probe else self.effective_width
+        process_width, upsample = self.plan(frame_width, effective)
+        return process_width, upsample, probe
+
+    def observe(self, frame_width, face_heights, cpu_ms, probe=False):
+        with self.lock:
+            self.frame_width = frame_width
+            self.frame_ms = self._smooth(self.frame_ms, cpu_ms)
+            if face_heights:
+                self.frames_without_faces = 0
+                ratio = min(face_heights) / float(frame_width)
+                if probe and self.face_ratio is not None and ratio < self.face_ratio:
+                    # A probe found a smaller face than those tracked: size for it
+                    # straight away, later frames at the old width would miss it.
+                    self.face_ratio = ratio
+                    self.effective_width = max(self.target_face_pixels, self.HOG_WINDOW_PIXELS) / ratio
+                else:
+                    self.face_ratio = self._smooth(self.face_ratio, ratio)
+            else:
+                self.frames_without_faces += 1
+
+            if self.mode == 'budget':
+                if self.frame_ms > 0:
+                    # HOG cost grows with pixel count, i.e. with width squared.
+                    step = (self.budget_ms / self.frame_ms) ** 0.5
+                    self.effective_width *= min(max(step, 0.75), 1.25)
+            elif self.frames_without_faces > self.idle_frames or self.face_ratio is None:
+                self.effective_width = float(self.search_width)
+            else:
+                wanted = max(self.target_face_pixels, self.HOG_WINDOW_PIXELS) / self.face_ratio
+                self.effective_width = self._smooth(self.effective_width, wanted)
+
+            self.effective_width = max(self.min_width, min(self.effective_width, 2.0 * self.max_width))
+
+    def get_state(self):
+        with self.lock:
+            frame_width = self.frame_width
+            state = {
+                'mode': self.mode,
+                'effective_width': round(self.effective_width),
+                'face_ratio': None if self.face_ratio is None else round(self.face_ratio, 4),
+                'frame_ms': None if self.frame_ms is None else round(self.frame_ms, 1),
+                'frames_without_faces': self.frames_without_faces,
+            }
+        if frame_width:
+            state['process_width'], state['upsample'] = self.plan(frame_width)
+        return state
+
+# --- Face Detector Backends ---
+class FaceDetector:
+    """Common interface for face detectors.
+
+    detect() takes an RGB image and returns boxes in face_recognition's
+    (top, right, bottom, left) order so callers can swap backends freely.
+    """
+
+    name = None
+
+    def detect(self, rgb_image, upsample=1):
+        raise NotImplementedError
+
+    @staticmethod
+    def _clip(box, shape):
+        top, right, bottom, left = box
+        height, width = shape[:2]
+        return (max(int(top), 0), min(int(right), width), min(int(bottom), height), max(int(left), 0))
+
+
+class HogFaceDetector(FaceDetector):
+    name = 'hog'
+
+    def detect(self, rgb_image, upsample=1):
+        return face_recognition.face_locations(rgb_image, number_of_times_to_upsample=upsample, model="hog")
+
+
+class CnnFaceDetector(FaceDetector):
+    # dlib's MMOD CNN; runs on the CPU when dlib is built without CUDA.
+    name = 'cnn'
+
+    def detect(self, rgb_image, upsample=1):
+        return face_recognition.face_locations(rgb_image, number_of_times_to_upsample=upsample, model="cnn")
+
+
+class HaarFaceDetector(FaceDetector):
+    name = 'haar'
+
+    def __init__(self, cascade_path=None, scale_factor=1.1, min_neighbors=5):
+        cascade_path = cascade_path or os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
+        self.cascade = cv2.CascadeClassifier(cascade_path)
+        if self.cascade.empty():
+            raise RuntimeError(f"Could not load Haar cascade from {cascade_path}")
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+
+    def detect(self, rgb_image, upsample=1):
+        gray = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2GRAY)
+        # Mirror HOG's behaviour: each upsample halves the smallest detectable face.
+        min_size = max(20, AdaptiveResolutionController.HOG_WINDOW_PIXELS >> upsample)
+        faces = self.cascade.detectMultiScale(gray, scaleFactor=self.scale_factor,
+                                              minNeighbors=self.min_neighbors, minSize=(min_size, min_size))
+        return [self._clip((y, x + w, y + h, x), rgb_image.shape) for (x, y, w, h) in faces]
+
+
+class DnnFaceDetector(FaceDetector):
+    # OpenCV's res10 SSD (Caffe) face detector loaded from local model files.
+    name = 'dnn'
+
+    def __init__(self, model_path, config_path, confidence=0.6, input_size=300):
+        if not os.path.exists(model_path) or not os.path.exists(config_path):
+            raise RuntimeError(f"DNN face model not found at {model_path} / {config_path}")
+        self.net = cv2.dnn.readNet(model_path, config_path)
+        self.confidence = confidence
+        self.input_size = input_size
+        self.lock = threading.Lock()
+
+    def detect(self, rgb_image, upsample=1):
+        height, width = rgb_image.shape[:2]
+        blob = cv2.dnn.blobFromImage(cv2.resize(rgb_image, (self.input_size, self.input_size)), 1.0,
+                                     (self.input_size, self.input_size), (104.0, 177.0, 123.0), swapRB=True)
+        with self.lock:
+            self.net.setInput(blob)
+            detections = self.net.forward()
+
+        boxes = []
+        for detection in detections[0, 0]:
+            if detection[2] < self.confidence:
+                continue
+            left, top, right, bottom = detection[3:7] * np.array([width, height, width, height])
+            box = self._clip((top, right, bottom, left), rgb_image.shape)
+            if box[2] > box[0] and box[1] > box[3]:
+                boxes.append(box)
+        return boxes
+
+
+def create_face_detector(name, settings=None):
+    settings = settings or {}
+    if name == 'hog':
+        return HogFaceDetector()
+    if name == 'cnn':
+        return CnnFaceDetector()
+    if name == 'haar':
+        return HaarFaceDetector(cascade_path=settings.get('haar_cascade_path'))
+    if name == 'dnn':
+        return DnnFaceDetector(settings.get('dnn_model_path'), settings.get('dnn_config_path'),
+                               confidence=settings.get('dnn_confidence', 0.6))
+    raise ValueError(f"Unknown face detector: {name}")
+
+# --- Face Matcher Class ---
+class FaceMatcher:
+    """Immutable snapshot of the gallery as one compact matrix.
+
+    Euclidean distances for a whole batch of probes come from a single
+    matrix multiply using |a - b|^2 = |a|^2 + |b|^2 - 2 a.b.
+
+    The inputs are one row per template. Rows are grouped so each
+    employee's templates form a contiguous block: 'best' mode scores an
+    employee by their closest template with one reduceat over the blocks,
+    'centroid' mode matches against one averaged row per employee.
+
+    Rows are stored as float32, float16 or int8 with a per-row scale.
+    Reduced-precision rows are widened one block at a time while matching,
+    so the full float32 matrix is never resident. With rerank > 0 the
+    closest few employees per probe are re-scored against exact float32
+    rows kept in a disk-backed memmap.
+    """
+
+    ENCODING_SIZE = 128
+    MODES = ('best', 'centroid')
+    PRECISIONS = ('float32', 'float16', 'int8')
+    BLOCK_ROWS = 8192
+
+    def __init__(self, encodings, names, employee_ids, tolerance=0.6, mode='best', precision='float32', rerank=0,
+                 margin=0.0):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown match mode: {mode}")
+        if precision not in self.PRECISIONS:
+            raise ValueError(f"Unknown gallery precision: {precision}")
+        templates = np.asarray(encodings, dtype=np.float32).reshape(-1, self.ENCODING_SIZE)
+        order = sorted(range(len(employee_ids)), key=lambda index: employee_ids[index])
+
+        self.names = []
+        self.employee_ids = []
+        starts = []
+        for position, index in enumerate(order):
+            if not self.employee_ids or self.employee_ids[-1] != employee_ids[index]:
+                self.employee_ids.append(employee_ids[index])
+                self.names.append(names[index])
+                starts.append(position)
+        templates = templates[order]
+        self.offsets = np.asarray(starts, dtype=np.intp)
+        self.template_count = len(templates)
+        self.tolerance = tolerance
+        self.margin = margin
+        self.mode = mode
+        self.precision = precision
+        self.rerank = rerank if precision != 'float32' else 0
+
+        if mode == 'centroid' and len(templates):
+            counts = np.diff(np.append(self.offsets, len(templates)))
+            rows = np.add.reduceat(templates, self.offsets, axis=0) / counts[:, None].astype(np.float32)
+            self.row_offsets = np.arange(len(rows), dtype=np.intp)
+        else:
+            rows = templates
+            self.row_offsets = self.offsets
+        del templates
+
+        self.scales = None
+        if precision == 'int8':
+            scales = np.abs(rows).max(axis=1) / 127.0 if len(rows) else np.zeros(0, dtype=np.float32)
+            scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+            self.matrix = np.round(rows / scales[:, None]).astype(np.int8)
+            self.scales = scales
+        else:
+            self.matrix = rows.astype(precision, copy=False)
+
+        # Norms come from the stored rows so the distance identity stays consistent.
+        self.squared_norms = np.empty(len(self.matrix), dtype=np.float32)
+        for start in range(0, len(self.matrix), self.BLOCK_ROWS):
+            block = self._widen(start, start + self.BLOCK_ROWS)
+            self.squared_norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+
+        self.exact = None
+        self.exact_rows = None
+        if self.rerank and len(rows):
+            self.exact = np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode='w+', shape=rows.shape)
+            self.exact[:] = rows
+            self.exact.flush()
+
+    def __len__(self):
+        return len(self.employee_ids)
+
+    @classmethod
+    def from_rows(cls, matrix, squared_norms, scales, row_offsets, names, employee_ids, tolerance=0.6, mode='best',
+                  margin=0.0):
+        # Wraps rows that are already stored (no quantizing or averaging),
+        # e.g. a slice of another matcher or arrays in shared memory.
+        matcher = object.__new__(cls)
+        matcher.names = names
+        matcher.employee_ids = employee_ids
+        matcher.row_offsets = row_offsets
+        matcher.offsets = row_offsets
+        matcher.template_count = len(matrix)
+        matcher.tolerance = tolerance
+        matcher.margin = margin
+        matcher.mode = mode
+        matcher.precision = 'int8' if scales is not None else matrix.dtype.name
+        matcher.rerank = 0
+        matcher.matrix = matrix
+        matcher.scales = scales
+        matcher.squared_norms = squared_norms
+        matcher.exact = None
+        matcher.exact_rows = None
+        return matcher
+
+    def subset(self, employee_indexes):
+        # A matcher over some employees, sliced from the stored rows as they are.
+        employee_indexes = np.asarray(sorted(employee_indexes), dtype=np.intp)
+        ends = np.append(self.row_offsets[1:], len(self.matrix))
+        counts = ends[employee_indexes] - self.row_offsets[employee_indexes]
+        rows = (np.concatenate([np.arange(self.row_offsets[index], ends[index]) for index in employee_indexes])
+                if len(employee_indexes) else np.zeros(0, dtype=np.intp))
+
+        matcher = FaceMatcher.from_rows(
+            self.matrix[rows], self.squared_norms[rows], self.scales[rows] if self.scales is not None else None,
+            np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.intp) if len(counts) else counts,
+            [self.names[index] for index in employee_indexes],
+            [self.employee_ids[index] for index in employee_indexes],
+            self.tolerance, self.mode, self.margin)
+        # The exact rows stay in the parent's memmap; only the row map is copied.
+        matcher.rerank = self.rerank
+        matcher.exact = self.exact
+        matcher.exact_rows = rows if self.exact_rows is None else self.exact_rows[rows]
+        return matcher
+
+    def _widen(self, start, stop):
+        block = self.matrix[start:stop].astype(np.float32)
+        if self.scales is not None:
+            block *= self.scales[start:stop, None]
+        return block
+
+    def memory_bytes(self):
+        # Resident size of the matching data, excluding the memmapped exact rows.
+        total = self.matrix.nbytes + self.squared_norms.nbytes
+        if self.scales is not None:
+            total += self.scales.nbytes
+        return total
+
+    def get_stats(self):
+        return {'employees': len(self), 'templates': self.template_count, 'mode': self.mode,
+                'tolerance': self.tolerance, 'margin': self.margin, 'precision': self.precision,
+                'rerank': self.rerank, 'memory_bytes': self.memory_bytes()}
+
+    def row_distances(self, probes):
+        # Distances to every matrix row: templates in 'best' mode, centroids in 'centroid' mode.
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, self.ENCODING_SIZE)
+        probe_norms = np.einsum('ij,ij->i', probes, probes)
+        if self.matrix.dtype == np.float32:
+            dots = probes.dot(self.matrix.T)
+        else:
+            dots = np.empty((len(probes), len(self.matrix)), dtype=np.float32)
+            for start in range(0, len(self.matrix), self.BLOCK_ROWS):
+                block = self._widen(start, start + self.BLOCK_ROWS)
+                dots[:, start:start + len(block)] = probes.dot(block.T)
+        squared = probe_norms[:, None] + self.squared_norms[None, :] - 2.0 * dots
+        return np.sqrt(np.maximum(squared, 0.0))
+
+    def distances(self, probes):
+        # Probes x employees.
+        distances = self.row_distances(probes)
+        if self.mode == 'best' and self.template_count > len(self):
+            distances = np.minimum.reduceat(distances, self.offsets, axis=1)
+        return distances
+
+    def _rerank(self, probes, distances, candidates):
+        # Replace the approximate distances of each probe's closest
+        # candidates with exact float32 ones.
+        candidates = min(candidates, len(self))
+        nearest = np.argpartition(distances, candidates - 1, axis=1)[:, :candidates]
+        for probe_index, employee_indexes in enumerate(nearest):
+            for employee_index in employee_indexes:
+                distances[probe_index, employee_index] = self.exact_distance(probes[probe_index], employee_index)
+        return distances
+
+    def exact_distance(self, probe, employee_index):
+        start = self.row_offsets[employee_index]
+        stop = self.row_offsets[employee_index + 1] if employee_index + 1 < len(self) else len(self.matrix)
+        if self.exact_rows is None:
+            rows = self.exact[start:stop]
+        else:
+            rows = self.exact[self.exact_rows[start:stop]]
+        return np.sqrt(((rows - probe) ** 2).sum(axis=1)).min()
+
+    def top_k(self, probes, k):
+        # (employee indexes, distances) of each probe's k closest employees,
+        # nearest first. argpartition finds them; only those k get sorted.
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, self.ENCODING_SIZE)
+        distances = self.distances(probes)
+        if self.exact is not None:
+            distances = self._rerank(probes, distances, max(self.rerank, k))
+        k = min(k, len(self))
+        if k < len(self):
+            indexes = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            indexes = np.broadcast_to(np.arange(len(self)), distances.shape).copy()
+        nearest = np.take_along_axis(distances, indexes, axis=1)
+        order = np.argsort(nearest, axis=1)
+        return np.take_along_axis(indexes, order, axis=1), np.take_along_axis(nearest, order, axis=1)
+
+    def candidates(self, probes, k):
+        # Per probe, a list of (name, employee_id, distance), nearest first.
+        if len(self) == 0:
+            return [[] for _ in range(len(np.asarray(probes).reshape(-1, self.ENCODING_SIZE)))]
+        indexes, distances = self.top_k(probes, k)
+        return [[(self.names[index], self.employee_ids[index], float(distance))
+                 for index, distance in zip(row_indexes, row_distances)]
+                for row_indexes, row_distances in zip(indexes, distances)]
+
+    def duplicate_pairs(self, threshold, block_rows=2048, progress=None):
+        # Employee pairs with any two rows closer than threshold, as
+        # (index_a, index_b, distance) with index_a < index_b. The row x row
+        # distance matrix is computed one block pair at a time so memory
+        # stays at block_rows^2 however large the gallery is.
+        counts = np.diff(np.append(self.row_offsets, len(self.matrix)))
+        row_employees = np.repeat(np.arange(len(self)), counts)
+        limit = np.float32(threshold) ** 2
+        closest = {}
+        for start in range(0, len(self.matrix), block_rows):
+            left = self._widen(start, start + block_rows)
+            left_norms = self.squared_norms[start:start + len(left)]
+            for other in range(start, len(self.matrix), block_rows):
+                right = self._widen(other, other + block_rows)
+                squared = left_norms[:, None] + self.squared_norms[None, other:other + len(right)] - 2.0 * left.dot(right.T)
+                if other == start:
+                    squared[np.tril_indices(len(left), 0, len(right))] = np.inf
+                rows_a, rows_b = np.nonzero(squared <= limit)
+                for row_a, row_b in zip(rows_a, rows_b):
+                    employee_a, employee_b = row_employees[start + row_a], row_employees[other + row_b]
+                    if employee_a == employee_b:
+                        continue
+                    pair = (min(employee_a, employee_b), max(employee_a, employee_b))
+                    distance = float(np.sqrt(max(squared[row_a, row_b], 0.0)))
+                    if distance < closest.get(pair, np.inf):
+                        closest[pair] = distance
+            if progress is not None:
+                progress(min(start + block_rows, len(self.matrix)), len(self.matrix))
+        return sorted(((a, b, distance) for (a, b), distance in closest.items()), key=lambda pair: pair[2])
+
+    def match(self, probes):
+        # Returns (name, employee_id, distance) per probe; distance is None
+        # when the gallery is empty. A best match within tolerance is still
+        # rejected when the runner-up is less than margin further away.
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, self.ENCODING_SIZE)
+        if len(self) == 0:
+            return [("Unknown", None, None)] * len(probes)
+
+        indexes, distances = self.top_k(probes, 2)
+
+        matches = []
+        for row_indexes, row_distances in zip(indexes, distances):
+            index, distance = row_indexes[0], float(row_distances[0])
+            runner_up = float(row_distances[1]) if len(row_distances) > 1 else float('inf')
+            if distance <= self.tolerance and runner_up - distance >= self.margin:
+                matches.append((self.names[index], self.employee_ids[index], distance))
+            else:
+                matches.append(("Unknown", None, distance))
+        return matches
+
+# --- Admission Control Classes ---
+class RecognitionOverloaded(Exception):
+    def __init__(self, message, status_code, retry_after=1):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounds how much recognition work runs and waits at once.
+
+    At most max_concurrent callers run; up to max_queue more may wait, each
+    no longer than its deadline. Beyond that work is refused with 429
+    (queue full) or 503 (deadline passed) instead of piling up latency.
+    """
+
+    def __init__(self, max_concurrent=4, max_queue=16, default_deadline=5.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.default_deadline = default_deadline
+        self.active = 0
+        self.waiting = 0
+        self.stats = {'admitted': 0, 'rejected_queue_full': 0, 'rejected_deadline': 0}
+        self.condition = threading.Condition()
+
+    def acquire(self, deadline=None):
+        # Takes a slot or raises; deadline is the time left in seconds, and
+        # work whose deadline has already passed is refused outright.
+        with self.condition:
+            if deadline is not None and deadline <= 0:
+                self.stats['rejected_deadline'] += 1
+                raise RecognitionOverloaded('Recognition deadline passed before the work could start.', 503)
+            if self.active >= self.max_concurrent and self.waiting >= self.max_queue:
+                self.stats['rejected_queue_full'] += 1
+                raise RecognitionOverloaded('Recognition queue is full, try again shortly.', 429)
+            self.waiting += 1
+            try:
+                admitted = self.condition.wait_for(lambda: self.active < self.max_concurrent,
+                                                   self.default_deadline if deadline is None else deadline)
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                self.stats['rejected_deadline'] += 1
+                raise RecognitionOverloaded('Recognition capacity not available before the deadline.', 503)
+            self.active += 1
+            self.stats['admitted'] += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    @contextmanager
+    def admit(self, deadline=None):
+        self.acquire(deadline)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats.update({'active': self.active, 'waiting': self.waiting,
+                          'max_concurrent': self.max_concurrent, 'max_queue': self.max_queue})
+        return stats
+
+# --- Face Recognition System Class ---
+class FaceRecognitionSystem:
+    # Identifies the face descriptor model in encoding versions.
+    ENCODER_NAME = 'dlib-resnet-v1'
+
+    def __init__(self, quality_gate=None, resolution_settings=None, detector_settings=None, encoding_settings=None,
+                 encoding_service=None, recognition_pool=None, match_tolerance=0.6, admission=None, match_mode='best',
+                 gallery_precision='float32', gallery_rerank=0, scope_settings=None, match_margin=0.0,
+                 shard_pool=None, duplicate_threshold=None, duplicate_action='reject', enrollment_image_settings=None):
+        self.db_manager = DatabaseManager()
+        self.match_tolerance = match_tolerance
+        self.match_mode = match_mode
+        self.match_margin = match_margin
+        self.shard_pool = shard_pool
+        self.duplicate_threshold = duplicate_threshold
+        self.duplicate_action = duplicate_action
+        self.enrollment_image_settings = enrollment_image_settings
+        self.gallery_precision = gallery_precision
+        self.gallery_rerank = gallery_rerank
+        self.matcher = FaceMatcher([], [], [], match_tolerance, match_mode, gallery_precision, gallery_rerank,
+                                   match_margin)
+        self.scope_settings = scope_settings if scope_settings is not None else {}
+        self.employee_scopes = {}
+        self.scoped_matchers = {}
+        self.admission = admission or AdmissionController()
+        self.recognition_pool = recognition_pool
+        self.load_known_faces()
+        self.quality_gate = quality_gate or FaceQualityGate()
+        self.resolution_settings = resolution_settings or {'mode': 'fixed'}
+        self.resolution_controllers = {}
+        self.detector_settings = detector_settings or {}
+        self.detectors = {}
+        self.encoding_settings = encoding_settings or {}
+        self.encoding_service = encoding_service
+        self.is_running = False
+        self.lock = threading.Lock()
+
+    def load_known_faces(self):
+        encodings, names, emp_ids = self.db_manager.get_face_templates()
+        # The matcher keeps its own compact copy; the float32 load buffer and
+        # per-template lists are dropped.
+        matcher = FaceMatcher(encodings, names, emp_ids, self.match_tolerance, self.match_mode,
+                              self.gallery_precision, self.gallery_rerank, self.match_margin)
+        del encodings, names, emp_ids
+        if self.shard_pool is not None:
+            matcher = ShardedFaceMatcher(matcher, self.shard_pool)
+        previous, self.matcher = self.matcher, matcher
+        if isinstance(previous, ShardedFaceMatcher):
+            previous.release()
+        self.employee_scopes = self.db_manager.get_employee_scopes()
+        self.scoped_matchers = {camera_id: self.build_scoped_matcher(scope)
+                                for camera_id, scope in self.scope_settings.get('cameras', {}).items()}
+        if self.recognition_pool is not None:
+            self.recognition_pool.notify_gallery_changed()
+        print(f"Loaded {self.matcher.template_count} face templates for {len(self.matcher)} employees from database")
+        versions = self.db_manager.get_encoding_versions()
+        if len(versions) > 1:
+            app.logger.warning(f"Gallery mixes encoding versions {sorted(versions)}; run a re-encoding job to align them")
+
+    def load_enrollment_image(self, image_path):
+        # Returns (image, None) or (None, error message).
+        if not os.path.exists(image_path):
+            return None, 'Image file not found'
+
+        image = face_recognition.load_image_file(image_path)
+
+        if image.size == 0:
+            return None, 'Invalid or corrupt image file'
+        return image, None
+
+    def encode_enrollment_face(self, image):
+        # Returns (encoding, None) or (None, error message).
+        face_locations = self.get_detector('enrollment').detect(image)
+
+        if len(face_locations) == 0:
+            return None, 'No face detected in the image. Please use a clear front-facing photo'
+
+        if len(face_locations) > 1:
+            return None, 'Multiple faces detected. Please use an image with only one face'
+
+        landmark_model, num_jitters = self.get_encoding_settings('enrollment')
+        raw_landmarks = compute_raw_landmarks(image, face_locations, landmark_model)
+        return encode_faces(image, raw_landmarks, num_jitters)[0], None
+    
+    def analyze_enrollment_frame(self, frame, process_width=1024):
+        # Returns (candidate, None) for a frame holding exactly one face that
+        # passes the quality gate, or (None, rejection reason). Someone
+        # enrolling stands close to the camera, so detection runs on a frame
+        # capped at process_width without upsampling; landmarks and the
+        # encoding still use the full-resolution frame.
+        rgb_image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        height, width = rgb_image.shape[:2]
+        scale = min(float(process_width) / width, 1.0)
+        detect_image = cv2.resize(rgb_image, (process_width, int(height * scale))) if scale < 1.0 else rgb_image
+        face_locations = self.get_detector('enrollment').detect(detect_image, 0)
+        if len(face_locations) != 1:
+            return None, 'no_face' if not face_locations else 'multiple_faces'
+        face_locations = [FaceDetector._clip(tuple(int(round(value / scale)) for value in face_locations[0]),
+                                             rgb_image.shape)]
+
+        landmark_model, _ = self.get_encoding_settings('enrollment')
+        passed, raw_landmarks, _ = self.quality_gate.filter(rgb_image, face_locations, landmark_model)
+        if not passed:
+            return None, 'low_quality'
+
+        location = passed[0]
+        return {
+            'image': rgb_image,
+            'raw_landmarks': raw_landmarks,
+            'score': self.quality_gate.blur_score(rgb_image, location) * (location[2] - location[0]),
+            'yaw': self.quality_gate.yaw_ratio(landmarks_to_dict(raw_landmarks[0], landmark_model)) or 0.0,
+        }, None
+
+    @staticmethod
+    def select_enrollment_frames(candidates, count, min_yaw_gap=0.08):
+        # Best-scoring frames first, skipping ones whose head pose is within
+        # min_yaw_gap of a frame already taken; tops up with the best of the
+        # rest when the burst has too little pose variety.
+        ranked = sorted(candidates, key=lambda candidate: candidate['score'], reverse=True)
+        chosen = []
+        for candidate in ranked:
+            if len(chosen) < count and all(abs(candidate['yaw'] - other['yaw']) >= min_yaw_gap for other in chosen):
+                chosen.append(candidate)
+        for candidate in ranked:
+            if len(chosen) < count and not any(candidate is other for other in chosen):
+                chosen.append(candidate)
+        return chosen
+
+    def encode_enrollment_candidate(self, candidate):
+        _, num_jitters = self.get_encoding_settings('enrollment')
+        if self.encoding_service is not None:
+            return self.encoding_service.encode(candidate['image'], candidate['raw_landmarks'], num_jitters)[0]
+        return encode_faces(candidate['image'], candidate['raw_landmarks'], num_jitters)[0]
+
+    def enroll_from_frames(self, employee_id, frames, details=None, templates=3, min_yaw_gap=0.08, wait=None):
+        # Turns a burst of camera frames into up to `templates` templates.
+        # With details (name, email, department, site) a new employee is
+        # created; without, the templates are added to an existing one.
+        # wait bounds each task's admission wait in seconds, so encodes are
+        # not refused just because analyzing the burst took a while.
+        if not frames:
+            return {'success': False, 'message': 'No frames were captured from the camera'}
+
+        def analyze(frame):
+            try:
+                with self.admission.admit(wait):
+                    return self.analyze_enrollment_frame(frame)
+            except RecognitionOverloaded:
+                return None, 'overloaded'
+
+        def encode(candidate):
+            with self.admission.admit(wait):
+                return self.encode_enrollment_candidate(candidate)
+
+        # Every detect and encode holds its own admission slot, and the pool is
+        # no wider than admission allows, so an enrollment competes with live
+        # recognition for capacity instead of running beside it.
+        workers = min(len(frames), self.admission.max_concurrent)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='enrollment') as executor:
+            analyzed = list(executor.map(analyze, frames))
+            rejected = {}
+            for _, reason in analyzed:
+                if reason:
+                    rejected[reason] = rejected.get(reason, 0) + 1
+            candidates = [candidate for candidate, _ in analyzed if candidate]
+            summary = {'frames': len(frames), 'usable_frames': len(candidates), 'rejected': rejected}
+            if not candidates:
+                if rejected.get('overloaded'):
+                    raise RecognitionOverloaded('Recognition capacity not available for enrollment, try again shortly.', 503)
+                return dict(summary, success=False,
+                            message='No usable frames. Face the camera alone, in good light, and hold still')
+
+            chosen = self.select_enrollment_frames(candidates, templates, min_yaw_gap)
+            encodings = list(executor.map(encode, chosen))
+
+        duplicates = [duplicate for duplicate in (self.find_duplicate(encoding, employee_id) for encoding in encodings)
+                      if duplicate]
+        if duplicates and (self.duplicate_action == 'reject' or details is None):
+            name, duplicate_id, _ = duplicates[0]
+            return dict(summary, success=False, message=f'This face is already enrolled as {name} ({duplicate_id})')
+
+        version = self.encoding_version()
+        images = [self.compress_source_image(candidate['image']) for candidate in chosen]
+        if details is not None:
+            if not self.db_manager.add_employee(employee_id, details['name'], details.get('email'),
+                                                details.get('department'), encodings[0], details.get('site'),
+                                                version, images[0], list(zip(encodings[1:], images[1:]))):
+                return dict(summary, success=False, message='Employee ID already exists')
+        elif not self.db_manager.add_face_templates(employee_id, list(zip(encodings, images)), version):
+            return dict(summary, success=False, message='Employee not found')
+
+        if duplicates:
+            self.db_manager.add_duplicate_flags([(employee_id, duplicate_id, distance)
+                                                 for _, duplicate_id, distance in duplicates], 'enrollment')
+        self.load_known_faces()
+        return dict(summary, success=True, templates=len(encodings),
+                    message=f'Enrolled {len(encodings)} face template(s) from the camera')
+
+    def encoding_version(self, pipeline='enrollment'):
+        # e.g. 'dlib-resnet-v1/hog/small/j5'; encodings with different
+        # versions are not guaranteed to be comparable.
+        landmark_model, num_jitters = self.get_encoding_settings(pipeline)
+        return f"{self.ENCODER_NAME}/{self.get_detector(pipeline).name}/{landmark_model}/j{num_jitters}"
+
+    def compress_source_image(self, image):
+        if not self.enrollment_image_settings:
+            return None
+        return compress_enrollment_image(image, **self.enrollment_image_settings)
+
+    def find_duplicate(self, face_encoding, employee_id):
+        # Closest other employee within duplicate_threshold, as (name, employee_id, distance).
+        if not self.duplicate_threshold:
+            return None
+        for candidate in self.matcher.candidates([face_encoding], 2)[0]:
+            if candidate[1] != employee_id and candidate[2] <= self.duplicate_threshold:
+                return candidate
+        return None
+
+    def add_new_employee(self, employee_id, name, email, department, image_path, site=None):
+        try:
+            image, error = self.load_enrollment_image(image_path)
+            if error:
+                return {'success': False, 'message': error}
+
+            face_encoding, error = self.encode_enrollment_face(image)
+            if error:
+                return {'success': False, 'message': error}
+
+            duplicate = self.find_duplicate(face_encoding, employee_id)
+            if duplicate and self.duplicate_action == 'reject':
+                return {'success': False, 'message': f'This face is already enrolled as {duplicate[0]} ({duplicate[1]})'}
+            
+            success = self.db_manager.add_employee(employee_id, name, email, department, face_encoding, site,
+                                                   self.encoding_version(), self.compress_source_image(image))
+            
+            if success:
+                if duplicate:
+                    app.logger.warning(f"Employee {employee_id} looks like {duplicate[1]} (distance {duplicate[2]:.3f})")
+                    self.db_manager.add_duplicate_flags([(employee_id, duplicate[1], duplicate[2])], 'enrollment')
+                self.load_known_faces()
+                try:
+                    os.remove(image_path)
+                except Exception as e:
+                    app.logger.warning(f"Could not remove temporary image file: {str(e)}")
+                return {'success': True, 'message': 'Employee added successfully'}
+            else:
+                return {'success': False, 'message': 'Employee ID already exists'}
+                
+        except Exception as e:
+            return {'success': False, 'message': f'Error processing image: {str(e)}'}
+
+    def add_employee_template(self, employee_id, image_path):
+        # Extra photos (other angles, glasses, lighting) become additional templates.
+        try:
+            image, error = self.load_enrollment_image(image_path)
+            if error:
+                return {'success': False, 'message': error}
+
+            face_encoding, error = self.encode_enrollment_face(image)
+            if error:
+                return {'success': False, 'message': error}
+
+            # A template that looks like someone else would make both employees ambiguous.
+            duplicate = self.find_duplicate(face_encoding, employee_id)
+            if duplicate:
+                return {'success': False, 'message': f'This face matches another employee: {duplicate[0]} ({duplicate[1]})'}
+
+            if not self.db_manager.add_face_template(employee_id, face_encoding, self.encoding_version(),
+                                                     self.compress_source_image(image)):
+                return {'success': False, 'message': 'Employee not found'}
+
+            self.load_known_faces()
+            return {'success': True, 'message': 'Face template added successfully'}
+
+        except Exception as e:
+            return {'success': False, 'message': f'Error processing image: {str(e)}'}
+        finally:
+            try:
+                if os.path.exists(image_path):
+                    os.remove(image_path)
+            except Exception as e:
+                app.logger.warning(f"Could not remove temporary image file: {str(e)}")
+    
+    def configure_camera(self, camera_id, detector=None, resolution=None, scope=None):
+        # Per-camera overrides of the detector backend, resolution controller settings and gallery scope.
+        if detector:
+            self.detector_settings.setdefault('cameras', {})[camera_id] = detector
+        if resolution:
+            self.resolution_settings.setdefault('cameras', {})[camera_id] = resolution
+        if scope:
+            self.scope_settings.setdefault('cameras', {})[camera_id] = scope
+            self.scoped_matchers[camera_id] = self.build_scoped_matcher(scope)
+
+    def in_scope(self, employee_id, scope):
+        # Explicit allow-list entries always match; otherwise the employee
+        # must satisfy every site/department condition the scope sets.
+        if employee_id in scope.get('employees', ()):
+            return True
+        if not scope.get('site') and not scope.get('departments'):
+            return False
+        department, site = self.employee_scopes.get(employee_id, (None, None))
+        sites = scope.get('site')
+        if sites and site not in ([sites] if isinstance(sites, str) else sites):
+            return False
+        if scope.get('departments') and department not in scope['departments']:
+            return False
+        return True
+
+    def build_scoped_matcher(self, scope):
+        matcher = self.matcher
+        return matcher.subset([index for index, employee_id in enumerate(matcher.employee_ids)
+                               if self.in_scope(employee_id, scope)])
+
+    def get_matcher(self, camera_id=None):
+        scoped = self.scoped_matchers.get(camera_id) if camera_id is not None else None
+        return scoped if scoped is not None else self.matcher
+
+    def match_encodings(self, face_encodings, camera_id=None):
+        # Cameras with a scope match only their slice of the gallery; with
+        # "fallback" set, faces unknown there are retried on the full gallery.
+        matcher = self.get_matcher(camera_id)
+        matches = matcher.match(face_encodings)
+        if matcher is self.matcher:
+            return matches
+
+        if self.scope_settings['cameras'][camera_id].get('fallback'):
+            misses = [index for index, (_, employee_id, _) in enumerate(matches) if employee_id is None]
+            if misses:
+                retried = self.matcher.match(np.asarray(face_encodings)[misses])
+                for index, match in zip(misses, retried):
+                    if match[1] is not None:
+                        matches[index] = match
+        return matches
+
+    def get_resolution_controller(self, camera_id):
+        settings = dict(self.resolution_settings)
+        settings.update(settings.pop('cameras', {}).get(camera_id, {}))
+        if settings.get('mode', 'fixed') == 'fixed':
+            return None
+        with self.lock:
+            if camera_id not in self.resolution_controllers:
+                self.resolution_controllers[camera_id] = AdaptiveResolutionController(**settings)
+            return self.resolution_controllers[camera_id]
+
+    def get_detector(self, use, camera_id=None):
+        # A per-camera override wins over the detector configured for the use ('live' or 'enrollment').
+        name = self.detector_settings.get('cameras', {}).get(camera_id) or self.detector_settings.get(use, 'hog')
+        with self.lock:
+            if name not in self.detectors:
+                try:
+                    self.detectors[name] = create_face_detector(name, self.detector_settings)
+                except Exception as e:
+                    app.logger.error(f"Could not load '{name}' face detector, falling back to HOG: {str(e)}")
+                    self.detectors[name] = HogFaceDetector()
+            return self.detectors[name]
+
+    def get_encoding_settings(self, pipeline):
+        # Pipelines are 'live', 'enrollment' and 'batch'
+        settings = self.encoding_settings.get(pipeline, {})
+        return settings.get('landmark_model', 'small'), settings.get('num_jitters', 1)
+
+    def recognize_faces(self, frame, camera_id=None, pipeline='live', resolution_scale=1.0, max_faces=None):
+        # resolution_scale and max_faces let a degradation controller trade
+        # accuracy for CPU on top of the resolution controller's choice.
+        width = frame.shape[1]
+        controller = self.get_resolution_controller(camera_id) if camera_id is not None else None
+        if controller is not None:
+            process_width, upsample, probe = controller.next_plan(width)
+        else:
+            process_width, upsample, probe = min(width, 1024), 1, False
+        if resolution_scale < 1.0:
+            process_width = max(160, int(process_width * resolution_scale))
+
+        if self.recognition_pool is not None and pipeline != 'enrollment':
+            result, face_heights, cpu_ms = self.recognition_pool.recognize(
+                self, frame, process_width, upsample, camera_id, pipeline, max_faces)
+        else:
+            started = time.thread_time()
+            result, face_heights = self.run_recognition(frame, process_width, upsample, camera_id, pipeline, max_faces)
+            cpu_ms = (time.thread_time() - started) * 1000.0
+
+        if controller is not None and cpu_ms is not None:
+            controller.observe(width, face_heights, cpu_ms, probe)
+        return result
+
+    def run_recognition(self, frame, process_width, upsample, camera_id=None, pipeline='live', max_faces=None):
+        # Returns the recognition result plus the heights (in frame pixels) of
+        # every detected face, which the resolution controller learns from.
+        # The result is (locations, names, employee_ids, scale, landmarks,
+        # best distances), with locations and landmarks in processed-frame
+        # coordinates.
+        scale = 1.0
+        face_heights = []
+        try:
+            height, width = frame.shape[:2]
+            if process_width < width:
+                scale = float(process_width) / width
+                process_frame = cv2.resize(frame, (process_width, int(height * scale)))
+            else:
+                process_frame = frame
+            
+            rgb_frame = cv2.cvtColor(process_frame, cv2.COLOR_BGR2RGB)
+            face_locations = self.get_detector('live', camera_id).detect(rgb_frame, upsample)
+            face_heights = [(bottom - top) / scale for (top, right, bottom, left) in face_locations]
+            
+            if not face_locations:
+                return ([], [], [], scale, [], []), face_heights
+
+            if max_faces and len(face_locations) > max_faces:
+                # Under load only the largest (closest) faces are worth encoding.
+                face_locations = sorted(face_locations, key=lambda box: box[2] - box[0], reverse=True)[:max_faces]
+
+            landmark_model, num_jitters = self.get_encoding_settings(pipeline)
+            face_locations, raw_landmarks, filtered_count = self.quality_gate.filter(rgb_frame, face_locations, landmark_model)
+            if filtered_count:
+                app.logger.debug(f"Quality gate dropped {filtered_count} face(s) before encoding")
+
+            if not face_locations:
+                return ([], [], [], scale, [], []), face_heights
+
+            if self.encoding_service is not None:
+                face_encodings = self.encoding_service.encode(rgb_frame, raw_landmarks, num_jitters)
+            else:
+                face_encodings = encode_faces(rgb_frame, raw_landmarks, num_jitters)
+            face_landmarks = [landmarks_to_dict(landmarks, landmark_model) for landmarks in raw_landmarks]
+            matches = self.match_encodings(face_encodings, camera_id)
+            face_names = [name for name, employee_id, distance in matches]
+            face_employee_ids = [employee_id for name, employee_id, distance in matches]
+            face_distances = [distance for name, employee_id, distance in matches]
+            
+            return (face_locations, face_names, face_employee_ids, scale, face_landmarks, face_distances), face_heights
+
+        except Exception as e:
+            app.logger.error(f"Error in face recognition: {str(e)}")
+            return ([], [], [], scale, [], []), face_heights
+
+# --- Degradation Controller Class ---
+class DegradationController:
+    """Load-shedding ladder for one camera pipeline.
+
+    Steps to a cheaper level when the smoothed frame time stays above the
+    target and back down once it has stayed well below it. Each level
+    scales detection resolution, recognizes only every Nth frame, caps the
+    faces encoded per frame and caps preview JPEG quality.
+    """
+
+    LEVELS = [
+        {'resolution_scale': 1.0, 'keyframe_interval': 1, 'max_faces': None, 'jpeg_quality': None},
+        {'resolution_scale': 0.75, 'keyframe_interval': 1, 'max_faces': None, 'jpeg_quality': None},
+        {'resolution_scale': 0.75, 'keyframe_interval': 2, 'max_faces': 5, 'jpeg_quality': 70},
+        {'resolution_scale': 0.5, 'keyframe_interval': 3, 'max_faces': 3, 'jpeg_quality': 60},
+        {'resolution_scale': 0.5, 'keyframe_interval': 5, 'max_faces': 1, 'jpeg_quality': 45},
+    ]
+
+    def __init__(self, target_ms=150.0, patience=5, recovery=50, recover_ratio=0.6, smoothing=0.2):
+        self.target_ms = target_ms
+        self.patience = patience
+        self.recovery = recovery
+        self.recover_ratio = recover_ratio
+        self.smoothing = smoothing
+        self.level = 0
+        self.frame_ms = None
+        self.frames_over = 0
+        self.frames_under = 0
+        self.level_changes = 0
+        self.lock = threading.Lock()
+
+    def current(self):
+        with self.lock:
+            return self.LEVELS[self.level]
+
+    def observe(self, frame_ms):
+        with self.lock:
+            if self.frame_ms is None:
+                self.frame_ms = frame_ms
+            else:
+                self.frame_ms += self.smoothing * (frame_ms - self.frame_ms)
+
+            if self.frame_ms > self.target_ms:
+                self.frames_over += 1
+                self.frames_under = 0
+            elif self.frame_ms < self.target_ms * self.recover_ratio:
+                self.frames_under += 1
+                self.frames_over = 0
+            else:
+                self.frames_over = self.frames_under = 0
+
+            if self.frames_over >= self.patience and self.level < len(self.LEVELS) - 1:
+                self._set_level(self.level + 1)
+            elif self.frames_under >= self.recovery and self.level > 0:
+                self._set_level(self.level - 1)
+
+    def _set_level(self, level):
+        self.level = level
+        self.level_changes += 1
+        self.frames_over = self.frames_under = 0
+
+    def get_state(self):
+        with self.lock:
+            state = {
+                'level': self.level,
+                'max_level': len(self.LEVELS) - 1,
+                'target_ms': self.target_ms,
+                'frame_ms': None if self.frame_ms is None else round(self.frame_ms, 1),
+                'level_changes': self.level_changes,
+            }
+            state.update(self.LEVELS[self.level])
+        return state
+
+# --- Camera Pipeline Classes ---
+def annotate_frame(frame, face_locations, face_names, scale, face_landmarks, draw_landmarks=False):
+    for (top, right, bottom, left), name in zip(face_locations, face_names):
+        top = int(top / scale)
+        right = int(right / scale)
+        bottom = int(bottom / scale)
+        left = int(left / scale)
+        
+        cv2.rectangle(frame, (left, top), (right, bottom), (0, 255, 0), 2)
+        cv2.rectangle(frame, (left, top - 35), (right, top), (0, 255, 0), cv2.FILLED)
+        cv2.putText(frame, name, (left + 6, top - 6), cv2.FONT_HERSHEY_DUPLEX, 0.8, (255, 255, 255), 1)
+
+    if draw_landmarks:
+        for landmarks in face_landmarks:
+            for points in landmarks.values():
+                for x, y in points:
+                    cv2.circle(frame, (int(x / scale), int(y / scale)), 2, (0, 255, 255), cv2.FILLED)
+
+
+def describe_faces(result):
+    # JSON-friendly faces from a recognition result, boxes in frame coordinates.
+    face_locations, face_names, face_employee_ids, scale, face_landmarks, face_distances = result
+    faces = []
+    for (top, right, bottom, left), name, employee_id, distance in zip(
+            face_locations, face_names, face_employee_ids, face_distances):
+        faces.append({
+            'box': [int(top / scale), int(right / scale), int(bottom / scale), int(left / scale)],
+            'name': name,
+            'employee_id': employee_id,
+            'distance': None if distance is None else round(distance, 4),
+        })
+    return faces
+
+
+def build_frame_metadata(camera_id, sequence, frame, result, status='connected'):
+    faces = describe_faces(result)
+    height, width = frame.shape[:2]
+    return {
+        'camera_id': camera_id,
+        'sequence': sequence,
+        'timestamp': time.time(),
+        'width': width,
+        'height': height,
+        'status': status,
+        'faces': faces,
+    }
+
+
+class TimedCapture:
+    """Opens and reads a cv2.VideoCapture on its own thread so a hung call can be abandoned.
+
+    open() and read() wait at most timeout seconds. A capture whose open or
+    read never returns (a dead RTSP host, a wedged USB device) is left to
+    its reader thread, which releases it if the call ever completes, while
+    the pipeline moves on to a fresh one.
+    """
+
+    def __init__(self, source, name, timeout_ms=None):
+        self.source = source
+        self.timeout_ms = timeout_ms
+        self.capture = None
+        self.opened = queue.Queue()
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            if isinstance(self.source, str) and self.timeout_ms:
+                # Lets FFmpeg itself give up on a dead stream instead of
+                # blocking for its own default.
+                self.capture = cv2.VideoCapture(self.source, cv2.CAP_ANY, [
+                    cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, self.timeout_ms, cv2.CAP_PROP_READ_TIMEOUT_MSEC, self.timeout_ms])
+            else:
+                self.capture = cv2.VideoCapture(self.source)
+            self.opened.put(self.capture.isOpened())
+            while self.requests.get():
+                try:
+                    result = self.capture.read()
+                except cv2.error:
+                    result = (False, None)
+                if self.closed:
+                    break
+                self.results.put(result)
+        finally:
+            if self.capture is not None:
+                self.capture.release()
+
+    def open(self, timeout):
+        # True once the device is open; False when it failed or took too long.
+        try:
+            return self.opened.get(timeout=timeout)
+        except queue.Empty:
+            return False
+
+    def read(self, timeout):
+        # (success, frame), or None when no frame arrived within timeout.
+        self.requests.put(True)
+        try:
+            return self.results.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def release(self, timeout=1.0):
+        self.closed = True
+        self.requests.put(False)
+        # Waits for a responsive device to be released before it is reopened;
+        # a hung open or read is not waited for.
+        self.thread.join(timeout)
+
+
+class CameraPipeline:
+    """Capture, recognition and annotation loop for one camera.
+
+    A single background thread reads the device, runs recognition and
+    publishes the latest annotated frame; any number of viewers wait on
+    the condition for new frames instead of touching the device. The
+    device is opened for the first subscriber and released once nobody
+    has been subscribed for idle_timeout seconds.
+    """
+
+    # JPEG output profiles (width, quality) kept encoded per camera
+    MAX_CACHED_PROFILES = 8
+
+    def __init__(self, camera_id, source, face_system, name=None, max_fps=None, draw_landmarks=False,
+                 idle_timeout=30.0, stall_timeout=5.0, reconnect_base_delay=0.5, reconnect_max_delay=30.0,
+                 jpeg_quality=80, output_width=None, recognition_deadline=0.5, degradation_target_ms=None):
+        self.camera_id = camera_id
+        self.source = source
+        self.face_system = face_system
+        self.name = name or str(camera_id)
+        self.max_fps = max_fps
+        self.draw_landmarks = draw_landmarks
+        self.idle_timeout = idle_timeout
+        self.stall_timeout = stall_timeout
+        self.reconnect_base_delay = reconnect_base_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.jpeg_quality = jpeg_quality
+        self.output_width = output_width
+        self.recognition_deadline = recognition_deadline
+        self.degradation = DegradationController(degradation_target_ms) if degradation_target_ms else None
+        self.quality_cap = None
+        self.shed_frames = 0
+        self.encoded_parts = {}
+        self.encode_locks = {}
+        self.encode_stats = {'encodes': 0, 'cache_hits': 0}
+        self.encode_lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.subscribers = 0
+        self.idle_since = None
+        self.stop_requested = False
+        self.latest_frame = None
+        self.latest_metadata = None
+        self.sequence = 0
+        self.fps = 0.0
+        self.recognition_ms = 0.0
+        self.status = 'disconnected'
+        self.reconnects = 0
+        self.dropped_frames = 0
+        self.stalls = 0
+        self.burst = None
+        self.condition = threading.Condition()
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            previous = self.thread
+        # Let a capture thread that is shutting down release the device first.
+        if previous is not None and previous is not threading.current_thread():
+            previous.join(timeout=5.0)
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self._run, name=f'camera-{self.camera_id}', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            thread = self.thread
+            self.condition.notify_all()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=5.0)
+
+    def subscribe(self):
+        with self.condition:
+            self.subscribers += 1
+            self.idle_since = None
+            self.stop_requested = False
+        self.start()
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers = max(self.subscribers - 1, 0)
+            if self.subscribers == 0:
+                self.idle_since = time.monotonic()
+
+    def capture_burst(self, count=15, duration=3.0):
+        # Raw (unannotated) frames spread evenly over duration seconds, or
+        # None when another burst is already capturing on this camera.
+        burst = {'frames': [], 'count': count, 'interval': duration / float(count), 'last': 0.0,
+                 'done': threading.Event()}
+        with self.condition:
+            if self.burst is not None:
+                return None
+            self.burst = burst
+        self.subscribe()
+        try:
+            # Allow for the camera opening (or reconnecting) before the first frame.
+            burst['done'].wait(duration + self.stall_timeout)
+        finally:
+            self.unsubscribe()
+            with self.condition:
+                self.burst = None
+        return burst['frames']
+
+    def _capture_for_burst(self, frame):
+        burst = self.burst
+        if burst is None or burst['done'].is_set():
+            return
+        now = time.monotonic()
+        if now - burst['last'] >= burst['interval']:
+            burst['frames'].append(frame.copy())
+            burst['last'] = now
+            if len(burst['frames']) >= burst['count']:
+                burst['done'].set()
+
+    def request_stop(self):
+        # Viewers announce they are leaving; release as soon as the last one is gone.
+        with self.condition:
+            self.stop_requested = True
+
+    def _should_idle_stop(self):
+        if self.subscribers > 0:
+            return False
+        if self.stop_requested:
+            return True
+        return self.idle_since is not None and time.monotonic() - self.idle_since >= self.idle_timeout
+
+    def _open_camera(self):
+        camera = TimedCapture(self.source, f'camera-{self.camera_id}-reader', int(self.stall_timeout * 1000))
+        if camera.open(self.stall_timeout):
+            return camera
+        camera.release()
+        return None
+
+    def _placeholder_frame(self, message):
+        height, width = self.latest_frame.shape[:2] if self.latest_frame is not None else (480, 640)
+        frame = np.full((height, width, 3), 40, dtype=np.uint8)
+        cv2.putText(frame, message, (20, height // 2), cv2.FONT_HERSHEY_DUPLEX, 0.8, (255, 255, 255), 1)
+        return frame
+
+    def _wait_to_reconnect(self, attempt):
+        # Exponential backoff; viewers keep receiving a placeholder meanwhile.
+        delay = min(self.reconnect_base_delay * (2 ** (attempt - 1)), self.reconnect_max_delay)
+        deadline = time.monotonic() + delay
+        placeholder = self._placeholder_frame(f"Camera {self.name} unavailable, reconnecting...")
+        while True:
+            with self.condition:
+                if not self.running or self._should_idle_stop():
+                    return
+            self._publish(placeholder, ([], [], [], 1.0, [], []), status='reconnecting')
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 1.0))
+
+    def _run(self):
+        camera = None
+        failures = 0
+        min_interval = 1.0 / self.max_fps if self.max_fps else 0.0
+        last_frame_at = None
+        frame_index = 0
+        last_result = None
+        try:
+            while True:
+                with self.condition:
+                    if not self.running:
+                        break
+                    if self._should_idle_stop():
+                        app.logger.info(f"Releasing idle camera {self.camera_id}")
+                        self.running = False
+                        break
+
+                if camera is None:
+                    camera = self._open_camera()
+                    if camera is None:
+                        failures += 1
+                        self.status = 'reconnecting'
+                        app.logger.error(f"Failed to initialize camera {self.camera_id}: could not open {self.source}")
+                        self._wait_to_reconnect(failures)
+                        continue
+                    if failures:
+                        self.reconnects += 1
+                        app.logger.info(f"Reconnected camera {self.camera_id} after {failures} attempt(s)")
+
+                loop_started = time.monotonic()
+                read = camera.read(self.stall_timeout)
+                success, frame = read if read is not None else (False, None)
+                if not success:
+                    if read is None:
+                        self.stalls += 1
+                        app.logger.warning(f"Camera {self.camera_id} gave no frame for {self.stall_timeout:.1f}s, reopening")
+                    else:
+                        self.dropped_frames += 1
+                        app.logger.error(f"Failed to capture frame from camera {self.camera_id}, reopening")
+                    camera.release()
+                    camera = None
+                    failures += 1
+                    self.status = 'reconnecting'
+                    self._wait_to_reconnect(failures)
+                    continue
+
+                failures = 0
+                self.status = 'connected'
+                self._capture_for_burst(frame)
+                level = self.degradation.current() if self.degradation else DegradationController.LEVELS[0]
+                self.quality_cap = level['jpeg_quality']
+                frame_index += 1
+                if last_result is not None and frame_index % level['keyframe_interval']:
+                    # Between keyframes the last recognition result is reused.
+                    result = last_result
+                else:
+                    recognition_started = None
+                    try:
+                        with self.face_system.admission.admit(self.recognition_deadline):
+                            # Timed from here so capture and admission waits don't count
+                            # as recognition cost.
+                            recognition_started = time.monotonic()
+                            result = self.face_system.recognize_faces(
+                                frame, camera_id=self.camera_id,
+                                resolution_scale=level['resolution_scale'], max_faces=level['max_faces'])
+                            self.recognition_ms = (time.monotonic() - recognition_started) * 1000.0
+                    except RecognitionOverloaded:
+                        # Keep the stream moving; this frame simply goes unrecognised.
+                        self.shed_frames += 1
+                        result = ([], [], [], 1.0, [], [])
+                    last_result = result
+                    if self.degradation is not None and recognition_started is not None:
+                        # Only recognised keyframes carry recognition cost, so only they
+                        # move the ladder; shedding is admission's call, not the ladder's.
+                        self.degradation.observe(self.recognition_ms)
+                face_locations, face_names, face_employee_ids, scale, face_landmarks, face_distances = result
+                annotate_frame(frame, face_locations, face_names, scale, face_landmarks, self.draw_landmarks)
+                self._publish(frame, result)
+
+                now = time.monotonic()
+                if last_frame_at is not None:
+                    self.fps = 0.9 * self.fps + 0.1 / max(now - last_frame_at, 1e-6)
+                last_frame_at = now
+
+                remaining = min_interval - (now - loop_started)
+                if remaining > 0:
+                    time.sleep(remaining)
+        finally:
+            if camera is not None:
+                camera.release()
+            self.status = 'disconnected'
+            self._stopped()
+
+    def _publish(self, frame, result, status='connected'):
+        with self.condition:
+            self.sequence += 1
+            self.latest_frame = frame
+            self.latest_metadata = build_frame_metadata(self.camera_id, self.sequence, frame, result, status)
+            self.condition.notify_all()
+
+    def _stopped(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def get_output_profile(self, frame_width, max_width=None, quality=None):
+        # Clients may only ask for less than the camera's own output settings.
+        # Requests are clamped to the frame and snapped to coarse steps so the
+        # number of distinct profiles (and cached encodes) per camera stays
+        # small; a width of None means the frame's own width.
+        width = min(self.output_width or frame_width, frame_width)
+        if max_width:
+            width = min(width, max(160, int(max_width) // 32 * 32))
+        if quality:
+            quality = min(self.jpeg_quality, max(10, int(quality) // 5 * 5))
+        quality = quality or self.jpeg_quality
+        if self.quality_cap:
+            quality = min(quality, self.quality_cap)
+        return (width if width < frame_width else None), quality
 
-# --- Face Recognition System Class ---
-class FaceRecognitionSystem:
-    def __init__(self):
-        self.db_manager = DatabaseManager()
-        self.known_face_encodings = []
-        self.known_face_names = []
-        self.known_employee_ids = []
-        self.load_known_faces()
-        self.camera = None
-        self.is_running = False
+    def get_stream_part(self, frame, sequence, width=None, quality=None):
+        # JPEG-encodes a published frame once per output profile and hands
+        # every viewer the same immutable multipart chunk.
+        profile = self.get_output_profile(frame.shape[1], width, quality)
+        with self.encode_lock:
+            profile_lock = self.encode_locks.setdefault(profile, threading.Lock())
+        with profile_lock:
+            with self.encode_lock:
+                cached = self.encoded_parts.get(profile)
+                if cached is not None and cached[0] == sequence:
+                    self.encode_stats['cache_hits'] += 1
+                    return cached[1]
+
+            output_width, quality = profile
+            if output_width:
+                height = int(frame.shape[0] * output_width / float(frame.shape[1]))
+                frame = cv2.resize(frame, (output_width, height), interpolation=cv2.INTER_AREA)
+            ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+            if not ret:
+                return None
+            part = b''.join((b'--frame\r\nContent-Type: image/jpeg\r\n\r\n', buffer.data, b'\r\n'))
+        with self.encode_lock:
+            self.encoded_parts[profile] = (sequence, part)
+            self.encode_stats['encodes'] += 1
+            # Keep only the most recently encoded profiles; one nobody is
+            # watching any more is dropped instead of held forever.
+            while len(self.encoded_parts) > self.MAX_CACHED_PROFILES:
+                stale = min((key for key in self.encoded_parts if key != profile),
+                            key=lambda key: self.encoded_parts[key][0])
+                del self.encoded_parts[stale]
+                self.encode_locks.pop(stale, None)
+        return part
+
+    def frames(self):
+        # Yields (sequence, frame, metadata) for each new annotated frame once;
+        # ends when the capture loop stops. Closing the generator (viewer
+        # disconnects) unsubscribes.
+        self.subscribe()
+        try:
+            last_sequence = self.sequence
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.sequence != last_sequence or not self.running, timeout=1.0)
+                    if self.sequence == last_sequence:
+                        if not self.running:
+                            return
+                        continue
+                    frame, metadata, last_sequence = self.latest_frame, self.latest_metadata, self.sequence
+                yield last_sequence, frame, metadata
+        finally:
+            self.unsubscribe()
+
+    def get_state(self):
+        with self.condition:
+            if self.running:
+                state = 'streaming' if self.subscribers else 'idle'
+            else:
+                state = 'stopped'
+            idle_for = round(time.monotonic() - self.idle_since, 1) if self.idle_since and self.running else None
+        return {
+            'name': self.name,
+            'state': state,
+            'subscribers': self.subscribers,
+            'idle_for': idle_for,
+            'idle_timeout': self.idle_timeout,
+            'running': self.running,
+            'status': self.status,
+            'reconnects': self.reconnects,
+            'dropped_frames': self.dropped_frames,
+            'stalls': self.stalls,
+            'shed_frames': self.shed_frames,
+            'degradation': self.degradation.get_state() if self.degradation else None,
+            'jpeg_encodes': self.encode_stats['encodes'],
+            'jpeg_cache_hits': self.encode_stats['cache_hits'],
+            'fps': round(self.fps, 1),
+            'recognition_ms': round(self.recognition_ms, 1),
+            'max_fps': self.max_fps,
+        }
+
+
+class CameraRegistry:
+    """Loads the camera list and owns one CameraPipeline per camera.
+
+    The config file is JSON of the form
+        {"cameras": [{"id": "front-door", "source": 0, "name": "Front door",
+                      "max_fps": 10, "cpu_budget_ms": 80, "detector": "hog",
+                      "scope": {"site": "HQ", "departments": ["Engineering"],
+                                "employees": ["E1001"], "fallback": true}}]}
+    where source is a device index, a video file path or a stream URL and
+    scope (optional) limits which employees the camera matches against. Any
+    of PIPELINE_OPTIONS may also be set per camera. Without a config file a single "default" camera on device 0 is used.
+    """
+
+    # Per-camera keys in the config file that override pipeline_defaults
+    PIPELINE_OPTIONS = ('name', 'max_fps', 'idle_timeout', 'stall_timeout', 'reconnect_base_delay', 'reconnect_max_delay',
+                        'jpeg_quality', 'output_width', 'recognition_deadline', 'degradation_target_ms')
+
+    def __init__(self, face_system, config_path=None, pipeline_defaults=None):
+        self.face_system = face_system
+        self.pipeline_defaults = pipeline_defaults or {}
+        self.pipelines = {}
+        self.default_camera_id = None
+        self.load(config_path)
+
+    @staticmethod
+    def parse_source(source):
+        if isinstance(source, str) and source.isdigit():
+            return int(source)
+        return source
+
+    def load(self, config_path):
+        cameras = [{'id': 'default', 'source': 0}]
+        if config_path and os.path.exists(config_path):
+            with open(config_path) as f:
+                cameras = json.load(f).get('cameras', []) or cameras
+
+        for camera in cameras:
+            camera_id = str(camera['id'])
+            resolution = {'mode': 'budget', 'budget_ms': camera['cpu_budget_ms']} if camera.get('cpu_budget_ms') else None
+            self.face_system.configure_camera(camera_id, detector=camera.get('detector'), resolution=resolution,
+                                              scope=camera.get('scope'))
+            options = dict(self.pipeline_defaults)
+            options.update({key: camera[key] for key in self.PIPELINE_OPTIONS if key in camera})
+            self.pipelines[camera_id] = CameraPipeline(
+                camera_id, self.parse_source(camera.get('source', 0)), self.face_system, **options)
+            if self.default_camera_id is None:
+                self.default_camera_id = camera_id
+
+        app.logger.info(f"Loaded {len(self.pipelines)} camera(s): {', '.join(self.pipelines)}")
+
+    def get(self, camera_id=None):
+        return self.pipelines.get(camera_id or self.default_camera_id)
+
+    def get_states(self):
+        return {camera_id: pipeline.get_state() for camera_id, pipeline in self.pipelines.items()}
+
+    def shutdown(self):
+        for pipeline in self.pipelines.values():
+            pipeline.stop()
+
+# --- Stream Limiter Class ---
+class StreamLimiter:
+    """Caps concurrent long-lived streams so that server threads stay free
+    for short requests (dashboard, attendance, enrollment)."""
+
+    def __init__(self, max_streams=48):
+        self.max_streams = max_streams
+        self.active = 0
+        self.rejected = 0
         self.lock = threading.Lock()
-        
-    def load_known_faces(self):
-        encodings, names, emp_ids = self.db_manager.get_employee_encodings()
-        self.known_face_encodings = encodings
-        self.known_face_names = names
-        self.known_employee_ids = emp_ids
-        print(f"Loaded {len(self.known_face_encodings)} face encodings from database")
-    
-    def add_new_employee(self, employee_id, name, email, department, image_path):
+
+    def try_acquire(self):
+        with self.lock:
+            if self.active >= self.max_streams:
+                self.rejected += 1
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.active = max(self.active - 1, 0)
+
+    def wrap(self, iterable):
+        return LimitedStream(iterable, self)
+
+    def get_stats(self):
+        with self.lock:
+            return {'active': self.active, 'max_streams': self.max_streams, 'rejected': self.rejected}
+
+
+class LimitedStream:
+    # WSGI servers call close() on the response iterable even when the
+    # client leaves before the first chunk, so the slot is always returned.
+    def __init__(self, iterable, limiter):
+        self.iterable = iterable
+        self.limiter = limiter
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
         try:
-            if not os.path.exists(image_path):
-                return {'success': False, 'message': 'Image file not found'}
-            
-            image = face_recognition.load_image_file(image_path)
-            
-            if image.size == 0:
-                return {'success': False, 'message': 'Invalid or corrupt image file'}
-            
-            face_locations = face_recognition.face_locations(image, model="hog")
-            
-            if len(face_locations) == 0:
-                return {'success': False, 'message': 'No face detected in the image. Please use a clear front-facing photo'}
-            
-            if len(face_locations) > 1:
-                return {'success': False, 'message': 'Multiple faces detected. Please use an image with only one face'}
-            
-            face_encodings = face_recognition.face_encodings(image, face_locations, num_jitters=5)
-            face_encoding = face_encodings[0]
-            
-            success = self.db_manager.add_employee(employee_id, name, email, department, face_encoding)
-            
-            if success:
-                self.load_known_faces()
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.limiter.release()
+
+# --- Recognition Process Pool ---
+# Worker-process state; only populated inside pool workers.
+_worker_system = None
+_worker_gallery_version = None
+_worker_loaded_version = None
+_worker_segments = {}
+
+
+def _recognition_worker_init(worker_settings, gallery_version):
+    global _worker_system, _worker_gallery_version, _worker_loaded_version
+    _worker_gallery_version = gallery_version
+    _worker_loaded_version = gallery_version.value
+    _worker_system = FaceRecognitionSystem(
+        quality_gate=FaceQualityGate(**worker_settings['quality_gate']),
+        detector_settings=worker_settings['detector_settings'],
+        encoding_settings=worker_settings['encoding_settings'],
+        match_tolerance=worker_settings['match_tolerance'],
+        match_mode=worker_settings['match_mode'],
+        gallery_precision=worker_settings['gallery_precision'],
+        gallery_rerank=worker_settings['gallery_rerank'],
+        scope_settings=worker_settings['scope_settings'],
+        match_margin=worker_settings['match_margin'],
+    )
+
+
+def _attach_segment(name):
+    segment = _worker_segments.get(name)
+    if segment is None:
+        # Spawned workers share the parent's resource tracker, which already
+        # tracks this name; the parent unlinks it when the ring closes.
+        segment = shared_memory.SharedMemory(name=name)
+        _worker_segments[name] = segment
+    return segment
+
+
+def _recognition_worker_task(segment_name, offset, shape, process_width, upsample, camera_id, pipeline, max_faces):
+    global _worker_loaded_version
+    version = _worker_gallery_version.value
+    if version != _worker_loaded_version:
+        _worker_system.load_known_faces()
+        _worker_loaded_version = version
+
+    frame = np.ndarray(shape, dtype=np.uint8, buffer=_attach_segment(segment_name).buf, offset=offset)
+    gate_before = _worker_system.quality_gate.get_stats()
+    started = time.thread_time()
+    result, face_heights = _worker_system.run_recognition(frame, process_width, upsample, camera_id, pipeline, max_faces)
+    cpu_ms = (time.thread_time() - started) * 1000.0
+    del frame
+
+    gate_after = _worker_system.quality_gate.get_stats()
+    gate_delta = {key: gate_after[key] - gate_before[key] for key in gate_after if key != 'filtered'}
+    return result, face_heights, cpu_ms, gate_delta
+
+
+class SharedFrameRing:
+    """Fixed-size frame slots in one shared memory segment for one camera."""
+
+    def __init__(self, slots, slot_bytes):
+        self.slot_bytes = slot_bytes
+        self.segment = shared_memory.SharedMemory(create=True, size=slots * slot_bytes)
+        self.free_slots = queue.Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+
+    @property
+    def name(self):
+        return self.segment.name
+
+    def acquire(self, timeout=None):
+        # A free slot index, or None when none came free within timeout.
+        try:
+            return self.free_slots.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def release(self, slot):
+        self.free_slots.put(slot)
+
+    def write(self, slot, frame):
+        offset = slot * self.slot_bytes
+        view = np.ndarray(frame.shape, dtype=np.uint8, buffer=self.segment.buf, offset=offset)
+        view[...] = frame
+        del view
+        return offset
+
+    def close(self):
+        self.segment.close()
+        self.segment.unlink()
+
+
+class RecognitionPool:
+    """Runs detection, encoding and matching in worker processes.
+
+    Frames are copied once into a per-camera shared memory ring and workers
+    read them in place, so only slot offsets go out and boxes, names and ids
+    come back. Workers reload the gallery when gallery_version changes.
+    """
+
+    def __init__(self, processes, worker_settings, ring_slots=4, max_frame_bytes=1920 * 1080 * 3, timeout=10.0):
+        self.processes = processes
+        self.worker_settings = worker_settings
+        self.ring_slots = ring_slots
+        self.max_frame_bytes = max_frame_bytes
+        self.timeout = timeout
+        self.pool = None
+        self.gallery_version = None
+        self.rings = {}
+        self.stats = {'tasks': 0, 'inline': 0, 'timeouts': 0}
+        self.lock = threading.Lock()
+
+    def _ensure_pool(self):
+        with self.lock:
+            if self.pool is None:
+                # spawn rather than fork: the web process is multi-threaded.
+                context = multiprocessing.get_context('spawn')
+                self.gallery_version = context.Value('i', 0)
+                self.pool = context.Pool(self.processes, initializer=_recognition_worker_init,
+                                         initargs=(self.worker_settings, self.gallery_version))
+                atexit.register(self.shutdown)
+            return self.pool
+
+    def _get_ring(self, camera_id):
+        with self.lock:
+            if camera_id not in self.rings:
+                self.rings[camera_id] = SharedFrameRing(self.ring_slots, self.max_frame_bytes)
+            return self.rings[camera_id]
+
+    def notify_gallery_changed(self):
+        if self.gallery_version is not None:
+            with self.gallery_version.get_lock():
+                self.gallery_version.value += 1
+
+    def recognize(self, system, frame, process_width, upsample, camera_id, pipeline, max_faces=None):
+        if frame.dtype != np.uint8 or frame.nbytes > self.max_frame_bytes:
+            with self.lock:
+                self.stats['inline'] += 1
+            started = time.thread_time()
+            result, face_heights = system.run_recognition(frame, process_width, upsample, camera_id, pipeline, max_faces)
+            return result, face_heights, (time.thread_time() - started) * 1000.0
+
+        pool = self._ensure_pool()
+        ring = self._get_ring(camera_id)
+        slot = ring.acquire(self.timeout)
+        if slot is None:
+            # Every slot is still being read by an earlier, slow task.
+            return self._timed_out(camera_id)
+        try:
+            offset = ring.write(slot, frame)
+            # The slot goes back only once the worker has finished with it,
+            # even if we stop waiting: a timed-out task may still be reading.
+            release = lambda _: ring.release(slot)
+            task = pool.apply_async(_recognition_worker_task,
+                                    (ring.name, offset, frame.shape, process_width, upsample, camera_id, pipeline,
+                                     max_faces), callback=release, error_callback=release)
+        except Exception:
+            ring.release(slot)
+            raise
+        try:
+            result, face_heights, cpu_ms, gate_delta = task.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            return self._timed_out(camera_id)
+
+        system.quality_gate.merge_stats(gate_delta)
+        with self.lock:
+            self.stats['tasks'] += 1
+        return result, face_heights, cpu_ms
+
+    def _timed_out(self, camera_id):
+        # No CPU time is reported, so the resolution controller skips the frame.
+        app.logger.error(f"Recognition worker timed out for camera {camera_id}")
+        with self.lock:
+            self.stats['timeouts'] += 1
+        return ([], [], [], 1.0, [], []), [], None
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['processes'] = self.processes
+        stats['cameras'] = len(self.rings)
+        return stats
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+            for ring in self.rings.values():
+                ring.close()
+            self.rings = {}
+
+# --- Sharded Gallery Matching ---
+# Shard-worker state; views and mappings of the current gallery generation.
+_shard_segments = {}
+_shard_views = {}
+
+
+def _shard_view(layout, start, stop):
+    key = (layout['generation'], start)
+    view = _shard_views.get(key)
+    if view is not None:
+        return view
+
+    if any(generation != layout['generation'] for generation, _ in _shard_views):
+        # A newer gallery was published; release the old one's mappings.
+        _shard_views.clear()
+        for segment in _shard_segments.values():
+            segment.close()
+        _shard_segments.clear()
+
+    arrays = {}
+    for field, (name, shape, dtype) in layout['arrays'].items():
+        segment = _shard_segments.get(name)
+        if segment is None:
+            # Spawned workers share the parent's resource tracker, which
+            # already tracks this name; the parent unlinks it.
+            segment = shared_memory.SharedMemory(name=name)
+            _shard_segments[name] = segment
+        arrays[field] = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+
+    row_offsets = arrays['row_offsets']
+    row_start = row_offsets[start]
+    row_stop = row_offsets[stop] if stop < len(row_offsets) else len(arrays['matrix'])
+    scales = arrays.get('scales')
+    view = FaceMatcher.from_rows(
+        arrays['matrix'][row_start:row_stop], arrays['squared_norms'][row_start:row_stop],
+        scales[row_start:row_stop] if scales is not None else None,
+        row_offsets[start:stop] - row_start, range(stop - start), range(stop - start), mode=layout['mode'])
+    _shard_views[key] = view
+    return view
+
+
+def _shard_top_k_task(layout, start, stop, probes, k):
+    indexes, distances = _shard_view(layout, start, stop).top_k(probes, k)
+    return indexes + start, distances
+
+
+class MatchShardPool:
+    """Worker processes that each search a slice of the gallery.
+
+    publish() copies a matcher's stored rows once into shared memory and
+    splits its employees into contiguous ranges of roughly equal row
+    counts; top_k() sends the probes to every range and merges the
+    per-shard top-k lists.
+    """
+
+    def __init__(self, processes, shards=None, min_employees=50000, timeout=2.0):
+        self.processes = processes
+        self.shards = shards or processes
+        self.min_employees = min_employees
+        self.timeout = timeout
+        self.pool = None
+        self.generation = 0
+        self.live_segments = []
+        self.stats = {'searches': 0, 'fallbacks': 0, 'published': 0}
+        self.lock = threading.Lock()
+
+    def _ensure_pool(self):
+        with self.lock:
+            if self.pool is None:
+                # spawn rather than fork: the web process is multi-threaded.
+                self.pool = multiprocessing.get_context('spawn').Pool(self.processes)
+                atexit.register(self.shutdown)
+            return self.pool
+
+    def publish(self, matcher):
+        # Returns (layout, segments); the parent keeps no mapping of its own.
+        arrays = {'matrix': matcher.matrix, 'squared_norms': matcher.squared_norms,
+                  'row_offsets': np.ascontiguousarray(matcher.row_offsets, dtype=np.intp)}
+        if matcher.scales is not None:
+            arrays['scales'] = matcher.scales
+
+        segments = []
+        layout = {'mode': matcher.mode, 'arrays': {}, 'shards': []}
+        for field, array in arrays.items():
+            segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)
+            view[...] = array
+            del view
+            segment.close()
+            segments.append(segment)
+            layout['arrays'][field] = (segment.name, array.shape, array.dtype.str)
+
+        rows = np.linspace(0, len(matcher.matrix), self.shards + 1)[1:-1]
+        bounds = [0] + sorted(set(np.searchsorted(matcher.row_offsets, rows).tolist()) - {0, len(matcher)}) + [len(matcher)]
+        layout['shards'] = list(zip(bounds[:-1], bounds[1:]))
+        with self.lock:
+            self.generation += 1
+            self.stats['published'] += 1
+            self.live_segments.extend(segments)
+            layout['generation'] = self.generation
+        return layout, segments
+
+    def retire(self, segments):
+        # Workers still mapping these keep them until their next generation.
+        with self.lock:
+            for segment in segments:
+                if segment in self.live_segments:
+                    self.live_segments.remove(segment)
                 try:
-                    os.remove(image_path)
-                except Exception as e:
-                    app.logger.warning(f"Could not remove temporary image file: {str(e)}")
-                return {'success': True, 'message': 'Employee added successfully'}
-            else:
-                return {'success': False, 'message': 'Employee ID already exists'}
-                
+                    segment.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def top_k(self, layout, probes, k):
+        pool = self._ensure_pool()
+        tasks = [pool.apply_async(_shard_top_k_task, (layout, start, stop, probes, k))
+                 for start, stop in layout['shards']]
+        results = [task.get(self.timeout) for task in tasks]
+        with self.lock:
+            self.stats['searches'] += 1
+        indexes = np.concatenate([shard_indexes for shard_indexes, _ in results], axis=1)
+        distances = np.concatenate([shard_distances for _, shard_distances in results], axis=1)
+        order = np.argsort(distances, axis=1)[:, :k]
+        return np.take_along_axis(indexes, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+    def record_fallback(self):
+        with self.lock:
+            self.stats['fallbacks'] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats.update({'processes': self.processes, 'shards': self.shards, 'min_employees': self.min_employees})
+        return stats
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+        self.retire(list(self.live_segments))
+
+
+class ShardedFaceMatcher(FaceMatcher):
+    """FaceMatcher whose top-k search is scattered over a MatchShardPool.
+
+    Shared memory is only published on the first search, so processes
+    that build a system but never match (pool workers) create nothing.
+    Scoped subsets and distances() use the local rows, which are also the
+    fallback when a shard fails or times out. Exact re-ranking, when
+    enabled, is applied to the merged candidates here.
+    """
+
+    def __init__(self, matcher, shard_pool):
+        self.__dict__.update(matcher.__dict__)
+        self.shard_pool = shard_pool
+        self.layout = None
+        self.segments = []
+        self.retired = False
+        self.shard_lock = threading.Lock()
+
+    def _get_layout(self):
+        with self.shard_lock:
+            if self.retired:
+                return None
+            if self.layout is None:
+                self.layout, self.segments = self.shard_pool.publish(self)
+            return self.layout
+
+    def release(self):
+        with self.shard_lock:
+            self.retired = True
+            self.shard_pool.retire(self.segments)
+            self.segments = []
+
+    def top_k(self, probes, k):
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, self.ENCODING_SIZE)
+        layout = self._get_layout() if len(self) >= self.shard_pool.min_employees else None
+        if layout is None:
+            return super().top_k(probes, k)
+
+        wanted = min(max(k, self.rerank), len(self))
+        try:
+            indexes, distances = self.shard_pool.top_k(layout, probes, wanted)
         except Exception as e:
-            return {'success': False, 'message': f'Error processing image: {str(e)}'}
-    
-    def recognize_faces(self, frame):
-        scale = 1.0
+            app.logger.warning(f"Sharded match failed, matching locally: {str(e)}")
+            self.shard_pool.record_fallback()
+            return super().top_k(probes, k)
+
+        if self.exact is not None:
+            for probe_index, employee_indexes in enumerate(indexes):
+                for column, employee_index in enumerate(employee_indexes):
+                    distances[probe_index, column] = self.exact_distance(probes[probe_index], employee_index)
+            order = np.argsort(distances, axis=1)
+            indexes = np.take_along_axis(indexes, order, axis=1)
+            distances = np.take_along_axis(distances, order, axis=1)
+        return indexes[:, :k], distances[:, :k]
+
+# --- Duplicate Scan Job ---
+class DuplicateScanJob:
+    """Background scan of the whole gallery for likely duplicate enrollments.
+
+    Runs FaceMatcher.duplicate_pairs on the gallery snapshot current when
+    it starts and records every pair found as a duplicate flag.
+    """
+
+    def __init__(self, face_system, threshold=0.5, block_rows=2048):
+        self.face_system = face_system
+        self.threshold = threshold
+        self.block_rows = block_rows
+        self.thread = None
+        self.state = {'status': 'idle'}
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return False
+            self.state = {'status': 'running', 'rows_done': 0, 'rows': 0, 'pairs': 0,
+                          'threshold': self.threshold, 'started_at': datetime.now().isoformat()}
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            return True
+
+    def _progress(self, rows_done, rows):
+        with self.lock:
+            self.state.update({'rows_done': rows_done, 'rows': rows})
+
+    def _run(self):
+        started = time.monotonic()
         try:
-            height, width = frame.shape[:2]
-            if width > 1024:
-                scale = 1024.0 / width
-                process_frame = cv2.resize(frame, (1024, int(height * scale)))
-            else:
-                process_frame = frame
-            
-            rgb_frame = cv2.cvtColor(process_frame, cv2.COLOR_BGR2RGB)
-            face_locations = face_recognition.face_locations(rgb_frame, model="hog")
-            
-            if not face_locations:
-                return [], [], [], scale
-            
-            face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
-            face_names = []
-            face_employee_ids = []
-            
-            for face_encoding in face_encodings:
-                if not self.known_face_encodings:
-                    face_names.append("Unknown")
-                    face_employee_ids.append(None)
-                    continue
+            matcher = self.face_system.matcher
+            pairs = matcher.duplicate_pairs(self.threshold, self.block_rows, self._progress)
+            flags = [(matcher.employee_ids[b], matcher.employee_ids[a], distance) for a, b, distance in pairs]
+            if flags:
+                self.face_system.db_manager.add_duplicate_flags(flags, 'scan')
+            status = {'status': 'done', 'pairs': len(flags)}
+        except Exception as e:
+            app.logger.error(f"Duplicate scan failed: {str(e)}")
+            status = {'status': 'failed', 'error': str(e)}
+        with self.lock:
+            self.state.update(status)
+            self.state['seconds'] = round(time.monotonic() - started, 2)
 
-                matches = face_recognition.compare_faces(self.known_face_encodings, face_encoding, tolerance=0.6)
-                name = "Unknown"
-                employee_id = None
-                
-                face_distances = face_recognition.face_distance(self.known_face_encodings, face_encoding)
-                if len(face_distances) > 0:
-                    best_match_index = np.argmin(face_distances)
-                    if matches[best_match_index]:
-                        name = self.known_face_names[best_match_index]
-                        employee_id = self.known_employee_ids[best_match_index]
-                
-                face_names.append(name)
-                face_employee_ids.append(employee_id)
-            
-            return face_locations, face_names, face_employee_ids, scale
+    def get_state(self):
+        with self.lock:
+            return dict(self.state)
+
+# --- Re-encoding Job ---
+# Re-encoding worker state; only populated inside job workers.
+_reencode_db = None
+_reencode_detector = None
+_reencode_settings = None
+
+
+def _reencode_worker_init(db_path, detector_name, detector_settings, landmark_model, num_jitters):
+    global _reencode_db, _reencode_detector, _reencode_settings
+    _reencode_db = DatabaseManager(db_path)
+    try:
+        _reencode_detector = create_face_detector(detector_name, detector_settings)
+    except Exception:
+        _reencode_detector = HogFaceDetector()
+    _reencode_settings = (landmark_model, num_jitters)
+
+
+def _reencode_worker_task(template_ids):
+    # Returns (template_id, encoding or None) for each stored source image.
+    landmark_model, num_jitters = _reencode_settings
+    results = []
+    for template_id, source_image in _reencode_db.get_template_images(template_ids):
+        image = cv2.imdecode(np.frombuffer(source_image, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            results.append((template_id, None))
+            continue
+        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        face_locations = _reencode_detector.detect(rgb_image)
+        if not face_locations:
+            results.append((template_id, None))
+            continue
+        largest = max(face_locations, key=lambda box: (box[2] - box[0]) * (box[1] - box[3]))
+        raw_landmarks = compute_raw_landmarks(rgb_image, [largest], landmark_model)
+        results.append((template_id, encode_faces(rgb_image, raw_landmarks, num_jitters)[0]))
+    return results
+
+
+class ReencodingJob:
+    """Re-encodes stored enrollment photos with the current enrollment settings.
+
+    Templates are processed in chunks on a process pool and each chunk's
+    results are staged in the pending_* columns, so a stopped or crashed
+    run resumes where it left off. The live gallery keeps its old
+    encodings until every template is done; then all staged encodings
+    are applied in one transaction and the matcher is swapped.
+    """
+
+    def __init__(self, face_system, processes=2, chunk_size=64):
+        self.face_system = face_system
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.thread = None
+        self.stop_requested = threading.Event()
+        self.state = {'status': 'idle'}
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return False
+            self.stop_requested.clear()
+            self.state = {'status': 'running', 'started_at': datetime.now().isoformat()}
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        self.stop_requested.set()
+
+    def _update(self, **values):
+        with self.lock:
+            self.state.update(values)
+
+    def _run(self):
+        system = self.face_system
+        db = system.db_manager
+        version = system.encoding_version()
+        landmark_model, num_jitters = system.get_encoding_settings('enrollment')
+        started = time.monotonic()
+        pool = None
+        try:
+            template_ids = db.get_reencode_candidates(version)
+            self._update(version=version, templates=len(template_ids), done=0, failed=0,
+                         stale_without_source=db.count_stale_without_source(version))
+            if template_ids:
+                # spawn rather than fork: the web process is multi-threaded.
+                pool = multiprocessing.get_context('spawn').Pool(
+                    self.processes, initializer=_reencode_worker_init,
+                    initargs=(db.db_path, system.get_detector('enrollment').name, system.detector_settings,
+                              landmark_model, num_jitters))
+                chunks = [template_ids[start:start + self.chunk_size]
+                          for start in range(0, len(template_ids), self.chunk_size)]
+                for results in pool.imap_unordered(_reencode_worker_task, chunks):
+                    db.save_pending_encodings(results, version)
+                    failed = sum(1 for _, encoding in results if encoding is None)
+                    with self.lock:
+                        self.state['done'] += len(results)
+                        self.state['failed'] += failed
+                    if self.stop_requested.is_set():
+                        self._update(status='stopped')
+                        return
 
+            applied = db.apply_pending_encodings(version)
+            if applied:
+                system.load_known_faces()
+            self._update(status='done', applied=applied)
         except Exception as e:
-            app.logger.error(f"Error in face recognition: {str(e)}")
-            return [], [], [], scale
+            app.logger.error(f"Re-encoding job failed: {str(e)}")
+            self._update(status='failed', error=str(e))
+        finally:
+            if pool is not None:
+                pool.terminate()
+            self._update(seconds=round(time.monotonic() - started, 2))
+
+    def get_state(self):
+        with self.lock:
+            state = dict(self.state)
+        state['versions'] = self.face_system.db_manager.get_encoding_versions()
+        return state
 
 # --- Flask Web Application ---
 app = Flask(__name__)
@@ -270,6 +2777,121 @@ app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg'}
 
+# Pre-encoding quality gate (sizes are relative to the processed frame)
+app.config['FACE_MIN_SIZE_RATIO'] = 0.06
+app.config['FACE_MIN_SIZE_PIXELS'] = 40
+app.config['FACE_MIN_BLUR_SCORE'] = 50.0
+app.config['FACE_MAX_YAW_RATIO'] = 0.35
+
+# Per-camera detection resolution: 'fixed' (1024 px cap), 'adaptive' (from face sizes) or 'budget' (CPU ms per frame)
+app.config['RESOLUTION_MODE'] = 'adaptive'
+app.config['RESOLUTION_MIN_WIDTH'] = 320
+app.config['RESOLUTION_MAX_WIDTH'] = 1024
+# Effective width (width * 2 ** upsample) used when no faces are tracked and
+# for periodic re-probes; 2048 matches the fixed mode's 1024 px with upsample 1
+app.config['RESOLUTION_SEARCH_WIDTH'] = 2048
+app.config['RESOLUTION_PROBE_INTERVAL'] = 30
+app.config['RESOLUTION_TARGET_FACE_PIXELS'] = 100
+app.config['RESOLUTION_BUDGET_MS'] = 80.0
+
+# Face detector backends: 'hog', 'cnn', 'haar' or 'dnn', per use and optionally per camera id
+app.config['DETECTOR_LIVE'] = 'hog'
+app.config['DETECTOR_ENROLLMENT'] = 'hog'
+app.config['DETECTOR_CAMERAS'] = {}
+app.config['DETECTOR_DNN_MODEL_PATH'] = 'models/res10_300x300_ssd_iter_140000.caffemodel'
+app.config['DETECTOR_DNN_CONFIG_PATH'] = 'models/deploy.prototxt'
+app.config['DETECTOR_DNN_CONFIDENCE'] = 0.6
+
+# Landmark model ('small' 5-point or 'large' 68-point) and jitter count per encoding pipeline.
+# 'small' is face_recognition.face_encodings()' own default, which produced every
+# stored encoding; switching to 'large' costs more CPU per face.
+app.config['ENCODING_PIPELINES'] = {
+    'live': {'landmark_model': 'small', 'num_jitters': 1},
+    'enrollment': {'landmark_model': 'small', 'num_jitters': 5},
+    'batch': {'landmark_model': 'small', 'num_jitters': 1},
+}
+app.config['OVERLAY_LANDMARKS'] = False
+
+# Cross-camera batched encoding; the wait bounds how long a lone request is held for company
+app.config['ENCODING_SERVICE_ENABLED'] = True
+app.config['ENCODING_BATCH_MAX_FACES'] = 32
+app.config['ENCODING_BATCH_MAX_WAIT_MS'] = 5.0
+
+# Recognition worker processes fed through shared memory; 0 keeps recognition in the request thread
+app.config['RECOGNITION_POOL_PROCESSES'] = 0
+app.config['RECOGNITION_POOL_RING_SLOTS'] = 4
+app.config['RECOGNITION_POOL_MAX_FRAME_BYTES'] = 1920 * 1080 * 3
+app.config['RECOGNITION_POOL_TIMEOUT'] = 10.0
+
+# Camera registry (JSON); without it a single camera on device 0 is used
+app.config['CAMERA_CONFIG'] = 'cameras.json'
+app.config['CAMERA_IDLE_TIMEOUT'] = 30.0
+app.config['CAMERA_STALL_TIMEOUT'] = 5.0
+app.config['CAMERA_RECONNECT_BASE_DELAY'] = 0.5
+app.config['CAMERA_RECONNECT_MAX_DELAY'] = 30.0
+
+# MJPEG output; output width None streams at capture resolution
+app.config['STREAM_JPEG_QUALITY'] = 80
+app.config['STREAM_OUTPUT_WIDTH'] = None
+
+# Stateless recognition API for edge clients
+app.config['RECOGNITION_API_MAX_IMAGES'] = 16
+app.config['RECOGNITION_API_WORKERS'] = 4
+
+# Gallery matching; /match takes packed little-endian float32 encodings
+app.config['MATCH_TOLERANCE'] = 0.6
+# Reject a match when the second-closest employee is within this distance of the closest
+app.config['MATCH_MARGIN'] = 0.05
+# 'best' scores each employee by their closest template, 'centroid' by their averaged template
+app.config['MATCH_MODE'] = 'best'
+# Gallery storage: 'float32', 'float16' or 'int8' (per-row scale). GALLERY_RERANK > 0
+# re-scores that many closest employees per face against exact float32 rows.
+app.config['GALLERY_PRECISION'] = os.environ.get('GALLERY_PRECISION', 'float32')
+app.config['GALLERY_RERANK'] = 4
+# Per-camera gallery scopes (camera id -> scope); cameras.json "scope" entries add to these
+app.config['GALLERY_SCOPES'] = {}
+# Split matching across processes for very large galleries; 0 keeps it in-process
+app.config['GALLERY_SHARD_PROCESSES'] = int(os.environ.get('GALLERY_SHARD_PROCESSES', 0))
+app.config['GALLERY_SHARD_MIN_EMPLOYEES'] = 50000
+app.config['GALLERY_SHARD_TIMEOUT'] = 2.0
+
+# Duplicate enrollments: faces closer than this to another employee are
+# rejected ('reject') or enrolled and recorded for review ('flag')
+app.config['DUPLICATE_THRESHOLD'] = 0.5
+app.config['DUPLICATE_ENROLLMENT_ACTION'] = 'reject'
+app.config['DUPLICATE_SCAN_BLOCK_ROWS'] = 2048
+
+# Enrollment photos kept (as JPEG) so encodings can be regenerated when
+# the detector, landmark model or jitter settings change
+app.config['ENROLLMENT_KEEP_IMAGES'] = True
+app.config['ENROLLMENT_IMAGE_MAX_SIDE'] = 640
+app.config['ENROLLMENT_IMAGE_QUALITY'] = 85
+app.config['REENCODE_PROCESSES'] = 2
+app.config['REENCODE_CHUNK_SIZE'] = 64
+
+# Live enrollment from a camera: a burst of frames is captured, the best
+# few with differing head poses become templates
+app.config['ENROLLMENT_BURST_FRAMES'] = 15
+app.config['ENROLLMENT_BURST_SECONDS'] = 3.0
+app.config['ENROLLMENT_TEMPLATES'] = 3
+app.config['ENROLLMENT_MIN_YAW_GAP'] = 0.08
+app.config['MATCH_API_MAX_ENCODINGS'] = 256
+app.config['MATCH_API_MAX_CANDIDATES'] = 10
+
+# Admission control for recognition work; deadlines are in seconds
+app.config['RECOGNITION_MAX_CONCURRENT'] = 4
+app.config['RECOGNITION_MAX_QUEUE'] = 16
+app.config['RECOGNITION_DEADLINE'] = 5.0
+app.config['RECOGNITION_MAX_DEADLINE'] = 30.0
+app.config['CAMERA_RECOGNITION_DEADLINE'] = 0.5
+
+# Per-camera load shedding: target frame time in ms, None disables the ladder
+app.config['DEGRADATION_TARGET_MS'] = 150.0
+
+# Long-lived MJPEG/SSE streams; keep this below the server's thread count
+# (see gunicorn.conf.py) so short requests always find a free thread
+app.config['STREAM_MAX_CLIENTS'] = int(os.environ.get('STREAM_MAX_CLIENTS', 48))
+
 # Setup logging
 if not app.debug:
     file_handler = RotatingFileHandler('app.log', maxBytes=10240, backupCount=10)
@@ -286,7 +2908,119 @@ moment = Moment(app)
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-face_system = FaceRecognitionSystem()
+quality_gate_settings = {
+    'min_face_ratio': app.config['FACE_MIN_SIZE_RATIO'],
+    'min_face_pixels': app.config['FACE_MIN_SIZE_PIXELS'],
+    'min_blur_score': app.config['FACE_MIN_BLUR_SCORE'],
+    'max_yaw_ratio': app.config['FACE_MAX_YAW_RATIO'],
+}
+detector_settings = {
+    'live': app.config['DETECTOR_LIVE'],
+    'enrollment': app.config['DETECTOR_ENROLLMENT'],
+    'cameras': app.config['DETECTOR_CAMERAS'],
+    'dnn_model_path': app.config['DETECTOR_DNN_MODEL_PATH'],
+    'dnn_config_path': app.config['DETECTOR_DNN_CONFIG_PATH'],
+    'dnn_confidence': app.config['DETECTOR_DNN_CONFIDENCE'],
+}
+scope_settings = {
+    'cameras': app.config['GALLERY_SCOPES'],
+}
+
+def init_services():
+    # Builds the recognition system, cameras and background jobs the routes
+    # use. Only the serving process calls this: spawned pool workers import
+    # this module just to reach their task functions and build what they need
+    # in their own initializers.
+    global face_system, camera_registry, stream_limiter, recognition_executor, duplicate_scan, reencoding_job
+
+    face_system = FaceRecognitionSystem(
+        quality_gate=FaceQualityGate(**quality_gate_settings),
+        resolution_settings={
+            'mode': app.config['RESOLUTION_MODE'],
+            'min_width': app.config['RESOLUTION_MIN_WIDTH'],
+            'max_width': app.config['RESOLUTION_MAX_WIDTH'],
+            'search_width': app.config['RESOLUTION_SEARCH_WIDTH'],
+            'probe_interval': app.config['RESOLUTION_PROBE_INTERVAL'],
+            'target_face_pixels': app.config['RESOLUTION_TARGET_FACE_PIXELS'],
+            'budget_ms': app.config['RESOLUTION_BUDGET_MS'],
+        },
+        detector_settings=detector_settings,
+        encoding_settings=app.config['ENCODING_PIPELINES'],
+        encoding_service=EncodingService(
+            max_batch=app.config['ENCODING_BATCH_MAX_FACES'],
+            max_wait_ms=app.config['ENCODING_BATCH_MAX_WAIT_MS'],
+        ) if app.config['ENCODING_SERVICE_ENABLED'] else None,
+        recognition_pool=RecognitionPool(
+            processes=app.config['RECOGNITION_POOL_PROCESSES'],
+            worker_settings={
+                'quality_gate': quality_gate_settings,
+                'detector_settings': detector_settings,
+                'encoding_settings': app.config['ENCODING_PIPELINES'],
+                'match_tolerance': app.config['MATCH_TOLERANCE'],
+                'match_mode': app.config['MATCH_MODE'],
+                'gallery_precision': app.config['GALLERY_PRECISION'],
+                'gallery_rerank': app.config['GALLERY_RERANK'],
+                'scope_settings': scope_settings,
+                'match_margin': app.config['MATCH_MARGIN'],
+            },
+            ring_slots=app.config['RECOGNITION_POOL_RING_SLOTS'],
+            max_frame_bytes=app.config['RECOGNITION_POOL_MAX_FRAME_BYTES'],
+            timeout=app.config['RECOGNITION_POOL_TIMEOUT'],
+        ) if app.config['RECOGNITION_POOL_PROCESSES'] > 0 else None,
+        match_tolerance=app.config['MATCH_TOLERANCE'],
+        match_mode=app.config['MATCH_MODE'],
+        gallery_precision=app.config['GALLERY_PRECISION'],
+        gallery_rerank=app.config['GALLERY_RERANK'],
+        scope_settings=scope_settings,
+        match_margin=app.config['MATCH_MARGIN'],
+        shard_pool=MatchShardPool(
+            processes=app.config['GALLERY_SHARD_PROCESSES'],
+            min_employees=app.config['GALLERY_SHARD_MIN_EMPLOYEES'],
+            timeout=app.config['GALLERY_SHARD_TIMEOUT'],
+        ) if app.config['GALLERY_SHARD_PROCESSES'] > 0 else None,
+        duplicate_threshold=app.config['DUPLICATE_THRESHOLD'],
+        duplicate_action=app.config['DUPLICATE_ENROLLMENT_ACTION'],
+        enrollment_image_settings={
+            'max_side': app.config['ENROLLMENT_IMAGE_MAX_SIDE'],
+            'quality': app.config['ENROLLMENT_IMAGE_QUALITY'],
+        } if app.config['ENROLLMENT_KEEP_IMAGES'] else None,
+        admission=AdmissionController(
+            max_concurrent=app.config['RECOGNITION_MAX_CONCURRENT'],
+            max_queue=app.config['RECOGNITION_MAX_QUEUE'],
+            default_deadline=app.config['RECOGNITION_DEADLINE'],
+        ),
+    )
+
+    camera_registry = CameraRegistry(
+        face_system,
+        app.config['CAMERA_CONFIG'],
+        pipeline_defaults={
+            'draw_landmarks': app.config['OVERLAY_LANDMARKS'],
+            'idle_timeout': app.config['CAMERA_IDLE_TIMEOUT'],
+            'stall_timeout': app.config['CAMERA_STALL_TIMEOUT'],
+            'reconnect_base_delay': app.config['CAMERA_RECONNECT_BASE_DELAY'],
+            'reconnect_max_delay': app.config['CAMERA_RECONNECT_MAX_DELAY'],
+            'jpeg_quality': app.config['STREAM_JPEG_QUALITY'],
+            'output_width': app.config['STREAM_OUTPUT_WIDTH'],
+            'recognition_deadline': app.config['CAMERA_RECOGNITION_DEADLINE'],
+            'degradation_target_ms': app.config['DEGRADATION_TARGET_MS'],
+        },
+    )
+    atexit.register(camera_registry.shutdown)
+
+    stream_limiter = StreamLimiter(app.config['STREAM_MAX_CLIENTS'])
+
+    recognition_executor = ThreadPoolExecutor(max_workers=app.config['RECOGNITION_API_WORKERS'],
+                                              thread_name_prefix='recognition-api')
+
+    duplicate_scan = DuplicateScanJob(face_system, app.config['DUPLICATE_THRESHOLD'], app.config['DUPLICATE_SCAN_BLOCK_ROWS'])
+    reencoding_job = ReencodingJob(face_system, app.config['REENCODE_PROCESSES'], app.config['REENCODE_CHUNK_SIZE'])
+
+
+# Spawned children are named before they import anything, so this also holds
+# while a worker is unpickling its initializer.
+if multiprocessing.current_process().name == 'MainProcess':
+    init_services()
 
 # --- Flask Routes ---
 @app.route('/')
@@ -311,6 +3045,8 @@ def delete_employee(employee_id):
         with face_system.db_manager.get_db_connection() as conn:
             # First, delete attendance records for the employee to maintain integrity
             conn.execute('DELETE FROM attendance WHERE employee_id = ?', (employee_id,))
+            conn.execute('DELETE FROM face_templates WHERE employee_id = ?', (employee_id,))
+            conn.execute('DELETE FROM duplicate_flags WHERE employee_id = ? OR duplicate_of = ?', (employee_id, employee_id))
             # Then, delete the employee
             cursor = conn.execute('DELETE FROM employees WHERE employee_id = ?', (employee_id,))
             conn.commit()
@@ -340,6 +3076,7 @@ def add_employee():
             name = request.form.get('name', '').strip()
             email = request.form.get('email', '').strip()
             department = request.form.get('department', '').strip()
+            site = request.form.get('site', '').strip()
 
             if not all([employee_id, name, email, department]):
                 flash('All fields are required.', 'error')
@@ -376,7 +3113,7 @@ def add_employee():
             print("DEBUG: Photo saved successfully.")
             
             print("DEBUG: Calling face_system.add_new_employee...")
-            result = face_system.add_new_employee(employee_id, name, email, department, filepath)
+            result = face_system.add_new_employee(employee_id, name, email, department, filepath, site)
             print(f"DEBUG: Result from face system: {result}")
             
             if result['success']:
@@ -401,6 +3138,23 @@ def add_employee():
 
     return render_template('add_employee.html')
 
+@app.route('/employees/<employee_id>/templates', methods=['POST'])
+def add_employee_template(employee_id):
+    photo = request.files.get('photo')
+    if photo is None or photo.filename == '':
+        return jsonify({'success': False, 'message': 'No photo selected'}), 400
+    if not allowed_file(photo.filename):
+        return jsonify({'success': False, 'message': 'Invalid file type. Please upload a PNG, JPG, or JPEG image'}), 400
+
+    filename = secure_filename(f"{employee_id}_template_{int(time.time() * 1000)}_{photo.filename}")
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    photo.save(filepath)
+
+    result = face_system.add_employee_template(employee_id, filepath)
+    if result['success']:
+        return jsonify(result)
+    return jsonify(result), 404 if result['message'] == 'Employee not found' else 400
+
 @app.route('/attendance')
 def attendance():
     records_from_db = face_system.db_manager.get_attendance_records(days=30)
@@ -434,45 +3188,241 @@ def mark_attendance():
 
 @app.route('/recognition')
 def recognition():
-    return render_template('recognition.html')
+    cameras = camera_registry.get_states()
+    return render_template('recognition.html', cameras=cameras, default_camera_id=camera_registry.default_camera_id)
 
-def gen_frames():
-    try:
-        if face_system.camera is None:
-            face_system.camera = cv2.VideoCapture(0)
-            if not face_system.camera.isOpened():
-                raise RuntimeError("Could not open camera")
-    except Exception as e:
-        app.logger.error(f"Failed to initialize camera: {str(e)}")
-        return
-        
-    while True:
-        success, frame = face_system.camera.read()
-        if not success:
-            app.logger.error("Failed to capture frame from camera")
-            break
-        
-        face_locations, face_names, face_employee_ids, scale = face_system.recognize_faces(frame)
-        
-        for (top, right, bottom, left), name in zip(face_locations, face_names):
-            top = int(top / scale)
-            right = int(right / scale)
-            bottom = int(bottom / scale)
-            left = int(left / scale)
-            
-            cv2.rectangle(frame, (left, top), (right, bottom), (0, 255, 0), 2)
-            cv2.rectangle(frame, (left, top - 35), (right, top), (0, 255, 0), cv2.FILLED)
-            cv2.putText(frame, name, (left + 6, top - 6), cv2.FONT_HERSHEY_DUPLEX, 0.8, (255, 255, 255), 1)
-    
-        ret, buffer = cv2.imencode('.jpg', frame)
-        if ret:
-            frame_bytes = buffer.tobytes()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+def gen_frames(pipeline, max_width=None, max_fps=None, quality=None):
+    # frames() only ever hands out the newest frame, so a slow or rate-limited
+    # viewer skips frames instead of queuing them.
+    min_interval = 1.0 / max_fps if max_fps else 0.0
+    last_sent = None
+    for sequence, frame, metadata in pipeline.frames():
+        now = time.monotonic()
+        if last_sent is not None and now - last_sent < min_interval:
+            continue
+        part = pipeline.get_stream_part(frame, sequence, max_width, quality)
+        if part is not None:
+            last_sent = now
+            yield part
 
 @app.route('/video_feed')
-def video_feed():
-    return Response(gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+@app.route('/video_feed/<camera_id>')
+def video_feed(camera_id=None):
+    # Optional per-viewer limits, e.g. /video_feed/lobby?max_width=480&max_fps=2&quality=50
+    pipeline = camera_registry.get(camera_id)
+    if pipeline is None:
+        return jsonify({'success': False, 'message': 'Camera not found.'}), 404
+    max_width = request.args.get('max_width', type=int)
+    max_fps = request.args.get('max_fps', type=float)
+    quality = request.args.get('quality', type=int)
+    if max_fps is not None and max_fps <= 0:
+        return jsonify({'success': False, 'message': 'max_fps must be positive.'}), 400
+    if not stream_limiter.try_acquire():
+        return jsonify({'success': False, 'message': 'Too many open streams, try again later.'}), 503
+    return Response(stream_limiter.wrap(gen_frames(pipeline, max_width, max_fps, quality)),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+def gen_events(pipeline):
+    for sequence, frame, metadata in pipeline.frames():
+        yield f"data: {json.dumps(metadata)}\n\n"
+
+@app.route('/recognition_events')
+@app.route('/recognition_events/<camera_id>')
+def recognition_events(camera_id=None):
+    pipeline = camera_registry.get(camera_id)
+    if pipeline is None:
+        return jsonify({'success': False, 'message': 'Camera not found.'}), 404
+    if not stream_limiter.try_acquire():
+        return jsonify({'success': False, 'message': 'Too many open streams, try again later.'}), 503
+    return Response(stream_limiter.wrap(gen_events(pipeline)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/stop_video_feed', methods=['POST'])
+@app.route('/stop_video_feed/<camera_id>', methods=['POST'])
+def stop_video_feed(camera_id=None):
+    pipeline = camera_registry.get(camera_id)
+    if pipeline is None:
+        return jsonify({'success': False, 'message': 'Camera not found.'}), 404
+    pipeline.request_stop()
+    return jsonify({'success': True, 'camera': pipeline.get_state()})
+
+def read_uploaded_images():
+    # Multipart uploads (any field name, one or many files) or a single
+    # image sent as the raw request body.
+    if request.files:
+        return [(image.filename, image.read()) for key in request.files for image in request.files.getlist(key)]
+    if request.data:
+        return [(None, request.data)]
+    return []
+
+def request_deadline():
+    # Absolute monotonic deadline from an optional ?deadline_ms=, capped by config.
+    deadline = app.config['RECOGNITION_DEADLINE']
+    deadline_ms = request.args.get('deadline_ms', type=float)
+    if deadline_ms is not None:
+        deadline = min(max(deadline_ms / 1000.0, 0.0), app.config['RECOGNITION_MAX_DEADLINE'])
+    return time.monotonic() + deadline
+
+def recognize_image(filename, frame):
+    # Runs on recognition_executor with an admission slot already held.
+    try:
+        result = face_system.recognize_faces(frame, pipeline='batch')
+    finally:
+        face_system.admission.release()
+    height, width = frame.shape[:2]
+    return {'filename': filename, 'width': width, 'height': height, 'faces': describe_faces(result)}
+
+@app.route('/recognize', methods=['POST'])
+def recognize():
+    images = read_uploaded_images()
+    if not images:
+        return jsonify({'success': False, 'message': 'No images received.'}), 400
+    if len(images) > app.config['RECOGNITION_API_MAX_IMAGES']:
+        return jsonify({'success': False, 'message': f"At most {app.config['RECOGNITION_API_MAX_IMAGES']} images per request."}), 400
+
+    # Images in a batch run concurrently so their encodes share batches and
+    # pool workers. Each one is admitted here, on the request thread, before
+    # it reaches the executor, so the executor never holds more than the
+    # admitted work and an overloaded image fails on its own.
+    deadline = request_deadline()
+    results = []
+    overloaded = []
+    for filename, data in images:
+        frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            results.append({'filename': filename, 'error': 'Could not decode image'})
+            continue
+        try:
+            face_system.admission.acquire(deadline - time.monotonic())
+        except RecognitionOverloaded as error:
+            overloaded.append(error)
+            results.append({'filename': filename, 'error': error.message, 'status': error.status_code})
+            continue
+        results.append(recognition_executor.submit(recognize_image, filename, frame))
+
+    if len(overloaded) == len(images):
+        raise overloaded[0]
+    results = [result.result() if isinstance(result, Future) else result for result in results]
+    for index, result in enumerate(results):
+        result['index'] = index
+    return jsonify({'success': True, 'results': results})
+
+@app.route('/match', methods=['POST'])
+def match_encodings():
+    # Body: N x 128 little-endian float32 values (512 bytes per encoding).
+    data = request.get_data()
+    row_bytes = FaceMatcher.ENCODING_SIZE * 4
+    if not data or len(data) % row_bytes:
+        return jsonify({'success': False, 'message': f'Body must be a multiple of {row_bytes} bytes of float32 encodings.'}), 400
+
+    probes = np.frombuffer(data, dtype='<f4').reshape(-1, FaceMatcher.ENCODING_SIZE)
+    if len(probes) > app.config['MATCH_API_MAX_ENCODINGS']:
+        return jsonify({'success': False, 'message': f"At most {app.config['MATCH_API_MAX_ENCODINGS']} encodings per request."}), 400
+    if not np.isfinite(probes).all():
+        return jsonify({'success': False, 'message': 'Encodings must be finite numbers.'}), 400
+
+    k = request.args.get('k', 0, type=int)
+    if not 0 <= k <= app.config['MATCH_API_MAX_CANDIDATES']:
+        return jsonify({'success': False, 'message': f"k must be between 0 and {app.config['MATCH_API_MAX_CANDIDATES']}."}), 400
+
+    camera_id = request.args.get('camera_id')
+    with face_system.admission.admit(request_deadline() - time.monotonic()):
+        matches = face_system.match_encodings(probes, camera_id)
+        candidates = face_system.get_matcher(camera_id).candidates(probes, k) if k else None
+
+    results = []
+    for index, (name, employee_id, distance) in enumerate(matches):
+        result = {'name': name, 'employee_id': employee_id, 'distance': None if distance is None else round(distance, 4)}
+        if candidates is not None:
+            result['candidates'] = [{'name': candidate_name, 'employee_id': candidate_id, 'distance': round(candidate_distance, 4)}
+                                    for candidate_name, candidate_id, candidate_distance in candidates[index]]
+        results.append(result)
+    return jsonify({'success': True, 'matches': results})
+
+@app.route('/duplicates')
+def duplicates():
+    flags = face_system.db_manager.get_duplicate_flags()
+    return jsonify({'success': True, 'scan': duplicate_scan.get_state(), 'flags': [
+        {'employee_id': flag['employee_id'], 'name': flag['name'], 'duplicate_of': flag['duplicate_of'],
+         'duplicate_name': flag['duplicate_name'], 'distance': round(flag['distance'], 4), 'source': flag['source'],
+         'created_at': str(flag['created_at'])}
+        for flag in flags
+    ]})
+
+@app.route('/duplicates/scan', methods=['POST'])
+def scan_duplicates():
+    if not duplicate_scan.start():
+        return jsonify({'success': False, 'message': 'A duplicate scan is already running.'}), 409
+    return jsonify({'success': True, 'scan': duplicate_scan.get_state()}), 202
+
+@app.route('/enroll_live', methods=['POST'])
+@app.route('/enroll_live/<camera_id>', methods=['POST'])
+def enroll_live(camera_id=None):
+    # Enrolls whoever stands in front of the camera. With name, email and
+    # department a new employee is created; with only employee_id the
+    # captured templates are added to that employee.
+    pipeline = camera_registry.get(camera_id)
+    if pipeline is None:
+        return jsonify({'success': False, 'message': 'Camera not found.'}), 404
+
+    form = request.get_json(silent=True) or request.form
+    employee_id = (form.get('employee_id') or '').strip()
+    if not employee_id.isalnum():
+        return jsonify({'success': False, 'message': 'Employee ID must contain only letters and numbers'}), 400
+
+    details = None
+    name = (form.get('name') or '').strip()
+    if name:
+        details = {key: (form.get(key) or '').strip() for key in ('email', 'department', 'site')}
+        details['name'] = name
+        if not details['email'] or not details['department']:
+            return jsonify({'success': False, 'message': 'Email and department are required for a new employee.'}), 400
+        if '@' not in details['email']:
+            return jsonify({'success': False, 'message': 'Please enter a valid email address'}), 400
+
+    frames = pipeline.capture_burst(app.config['ENROLLMENT_BURST_FRAMES'], app.config['ENROLLMENT_BURST_SECONDS'])
+    if frames is None:
+        return jsonify({'success': False, 'message': 'This camera is already capturing an enrollment.'}), 409
+
+    result = face_system.enroll_from_frames(employee_id, frames, details, app.config['ENROLLMENT_TEMPLATES'],
+                                            app.config['ENROLLMENT_MIN_YAW_GAP'], request_deadline() - time.monotonic())
+    if result['success']:
+        return jsonify(result)
+    return jsonify(result), 404 if result['message'] == 'Employee not found' else 400
+
+@app.route('/reencode', methods=['GET', 'POST'])
+def reencode():
+    if request.method == 'POST' and not reencoding_job.start():
+        return jsonify({'success': False, 'message': 'A re-encoding job is already running.'}), 409
+    return jsonify({'success': True, 'job': reencoding_job.get_state()}), 202 if request.method == 'POST' else 200
+
+@app.route('/reencode/stop', methods=['POST'])
+def stop_reencode():
+    reencoding_job.stop()
+    return jsonify({'success': True, 'job': reencoding_job.get_state()})
+
+@app.errorhandler(RecognitionOverloaded)
+def recognition_overloaded(error):
+    response = jsonify({'success': False, 'message': error.message})
+    response.status_code = error.status_code
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+@app.route('/recognition_stats')
+def recognition_stats():
+    return jsonify({
+        'admission': face_system.admission.get_stats(),
+        'gallery': face_system.matcher.get_stats(),
+        'gallery_shards': face_system.shard_pool.get_stats() if face_system.shard_pool else None,
+        'scoped_galleries': {camera_id: len(matcher) for camera_id, matcher in face_system.scoped_matchers.items()},
+        'streams': stream_limiter.get_stats(),
+        'quality_gate': face_system.quality_gate.get_stats(),
+        'encoding_service': face_system.encoding_service.get_stats() if face_system.encoding_service else None,
+        'recognition_pool': face_system.recognition_pool.get_stats() if face_system.recognition_pool else None,
+        'cameras': camera_registry.get_states(),
+        'resolution': {camera_id: controller.get_state()
+                       for camera_id, controller in face_system.resolution_controllers.items()},
+    })
 
 if __name__ == '__main__':
     print("=" * 50)
@@ -484,6 +3434,8 @@ if __name__ == '__main__':
     print("=" * 50)
     print("Press Ctrl+C to stop the server")
     print("=" * 50)
+    # Threaded so open video/event streams don't block other requests
+    app.run(host='0.0.0.0', port=5000, threaded=True)
     
     
 
@@ -0,0 +1,388 @@
+# benchmark.py
+# Offline benchmarks for the Face Recognition Attendance System
+#
+# Usage:
+#   python benchmark.py fixture [--portraits DIR] [--output fixtures/detection]
+#   python benchmark.py detectors --frames fixtures/detection [--detectors hog cnn haar dnn]
+#   python benchmark.py streams --url http://localhost:5000 --viewers 40 --duration 30
+#   python benchmark.py gallery --employees 10000 --precisions float32 float16 int8
+#   python benchmark.py shards --employees 200000 --shards 1 2 4 8
+#
+# The detection fixture directory holds the frames plus an annotations.json
+# mapping each file name to its ground-truth boxes as [top, right, bottom, left].
+# `fixture` builds one from single-person portraits (by default the enrollment
+# photos stored in the database) pasted into larger frames at known sizes.
+
+import argparse
+import glob
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import cv2
+import numpy as np
+
+
+def load_portraits(portraits_dir, db_path):
+    # BGR images, each expected to show one person.
+    if portraits_dir:
+        paths = sorted(path for pattern in ('*.jpg', '*.jpeg', '*.png')
+                       for path in glob.glob(os.path.join(portraits_dir, pattern)))
+        return [image for image in (cv2.imread(path) for path in paths) if image is not None]
+    with sqlite3.connect(db_path) as conn:
+        try:
+            rows = conn.execute('SELECT source_image FROM face_templates WHERE source_image IS NOT NULL').fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+    images = (cv2.imdecode(np.frombuffer(row[0], dtype=np.uint8), cv2.IMREAD_COLOR) for row in rows)
+    return [image for image in images if image is not None]
+
+
+def build_detection_fixture(args):
+    # Ground truth comes from the known paste transform: each portrait's face
+    # is located once at full size (where any detector finds it) and every
+    # pasted copy's box follows from its scale and offset, so small faces are
+    # annotated exactly even where the detectors under test miss them.
+    from app import create_face_detector
+
+    detector = create_face_detector('hog')
+    faces = []
+    for image in load_portraits(args.portraits, args.db):
+        boxes = detector.detect(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), 1)
+        if len(boxes) == 1:
+            faces.append((image, boxes[0]))
+    if not faces:
+        print("No single-face portraits found; pass --portraits DIR or enroll employees with ENROLLMENT_KEEP_IMAGES")
+        return
+
+    rng = random.Random(args.seed)
+    os.makedirs(args.output, exist_ok=True)
+    annotations = {}
+    for index in range(args.frames):
+        frame = np.full((args.height, args.width, 3), rng.randint(60, 190), dtype=np.uint8)
+        frame = cv2.add(frame, np.random.default_rng(index).integers(0, 25, frame.shape, dtype=np.uint8))
+        boxes = []
+        for _ in range(rng.randint(1, args.max_faces)):
+            image, (top, right, bottom, left) = rng.choice(faces)
+            scale = rng.uniform(args.min_face, args.max_face) / float(bottom - top)
+            # Keep some head and shoulders around the face so it looks natural to the detectors.
+            margin = (bottom - top) // 2
+            crop_top, crop_left = max(top - margin, 0), max(left - margin, 0)
+            crop = image[crop_top:bottom + margin, crop_left:right + margin]
+            crop = cv2.resize(crop, (max(int(crop.shape[1] * scale), 1), max(int(crop.shape[0] * scale), 1)),
+                              interpolation=cv2.INTER_AREA)
+            if crop.shape[0] >= args.height or crop.shape[1] >= args.width:
+                continue
+            y = rng.randint(0, args.height - crop.shape[0])
+            x = rng.randint(0, args.width - crop.shape[1])
+            area = [y, x + crop.shape[1], y + crop.shape[0], x]
+            if any(area[0] < other[2] and other[0] < area[2] and area[3] < other[1] and other[3] < area[1]
+                   for other in boxes):
+                continue  # would cover a face already placed
+            box = [int(y + (top - crop_top) * scale), int(x + (right - crop_left) * scale),
+                   int(y + (bottom - crop_top) * scale), int(x + (left - crop_left) * scale)]
+            frame[y:y + crop.shape[0], x:x + crop.shape[1]] = crop
+            boxes.append(box)
+        filename = f"frame_{index:04d}.jpg"
+        cv2.imwrite(os.path.join(args.output, filename), frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        annotations[filename] = boxes
+
+    with open(os.path.join(args.output, 'annotations.json'), 'w') as f:
+        json.dump(annotations, f, indent=1)
+    print(f"Wrote {len(annotations)} frames with {sum(len(boxes) for boxes in annotations.values())} faces "
+          f"from {len(faces)} portraits to {args.output}")
+
+
+def load_detection_fixture(frames_dir):
+    path = os.path.join(frames_dir, 'annotations.json')
+    if not os.path.exists(path):
+        print(f"No {path}; build one with: python benchmark.py fixture --output {frames_dir}")
+        return []
+    with open(path) as f:
+        annotations = json.load(f)
+
+    frames = []
+    for filename, boxes in sorted(annotations.items()):
+        image = cv2.imread(os.path.join(frames_dir, filename))
+        if image is None:
+            print(f"Skipping unreadable frame: {filename}")
+            continue
+        frames.append((filename, cv2.cvtColor(image, cv2.COLOR_BGR2RGB), [tuple(box) for box in boxes]))
+    return frames
+
+
+def box_iou(a, b):
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(0, bottom - top) * max(0, right - left)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    union = area_a + area_b - intersection
+    return intersection / float(union) if union > 0 else 0.0
+
+
+def count_matches(expected, detected, threshold=0.5):
+    # Greedy one-to-one matching of detections to ground-truth boxes.
+    remaining = list(detected)
+    matched = 0
+    for truth in expected:
+        scores = [box_iou(truth, box) for box in remaining]
+        if scores and max(scores) >= threshold:
+            remaining.pop(scores.index(max(scores)))
+            matched += 1
+    return matched
+
+
+def benchmark_detectors(args):
+    # Imported here so the HTTP load test runs without loading the gallery.
+    from app import app, create_face_detector
+
+    frames = load_detection_fixture(args.frames)
+    if not frames:
+        print("No frames to benchmark")
+        return
+
+    settings = {
+        'dnn_model_path': app.config['DETECTOR_DNN_MODEL_PATH'],
+        'dnn_config_path': app.config['DETECTOR_DNN_CONFIG_PATH'],
+        'dnn_confidence': app.config['DETECTOR_DNN_CONFIDENCE'],
+    }
+    total_faces = sum(len(boxes) for _, _, boxes in frames)
+
+    print(f"{len(frames)} frames, {total_faces} annotated faces, upsample={args.upsample}")
+    print(f"{'detector':<10}{'ms/frame':>10}{'fps':>8}{'recall':>8}{'extra':>8}")
+    for name in args.detectors:
+        try:
+            detector = create_face_detector(name, settings)
+        except Exception as e:
+            print(f"{name:<10}skipped: {str(e)}")
+            continue
+
+        detector.detect(frames[0][1], args.upsample)  # warm-up
+
+        matched = 0
+        extra = 0
+        started = time.perf_counter()
+        for _, rgb_frame, expected in frames:
+            detected = detector.detect(rgb_frame, args.upsample)
+            hits = count_matches(expected, detected, args.iou)
+            matched += hits
+            extra += len(detected) - hits
+        elapsed = time.perf_counter() - started
+
+        ms_per_frame = elapsed * 1000.0 / len(frames)
+        recall = matched / float(total_faces) if total_faces else 0.0
+        print(f"{name:<10}{ms_per_frame:>10.1f}{1000.0 / ms_per_frame:>8.1f}{recall:>8.2f}{extra:>8}")
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def watch_stream(url, stop_at, counts, index):
+    try:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            while time.monotonic() < stop_at:
+                chunk = response.read(16384)
+                if not chunk:
+                    break
+                counts[index] += chunk.count(b'--frame') or chunk.count(b'data: ')
+    except (urllib.error.URLError, OSError) as e:
+        counts[index] = -1
+        print(f"viewer {index}: {str(e)}")
+
+
+def benchmark_streams(args):
+    # Opens many MJPEG/SSE viewers against a running server and measures how
+    # short requests fare while they are connected.
+    stop_at = time.monotonic() + args.duration
+    counts = [0] * args.viewers
+    viewers = []
+    for index in range(args.viewers):
+        path = args.stream_path if index % 2 == 0 or not args.events_path else args.events_path
+        thread = threading.Thread(target=watch_stream, args=(args.url + path, stop_at, counts, index), daemon=True)
+        thread.start()
+        viewers.append(thread)
+
+    latencies = []
+    errors = 0
+    while time.monotonic() < stop_at:
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(args.url + args.request_path, timeout=10) as response:
+                response.read()
+            latencies.append((time.perf_counter() - started) * 1000.0)
+        except (urllib.error.URLError, OSError):
+            errors += 1
+        time.sleep(args.interval)
+
+    for thread in viewers:
+        thread.join(timeout=5)
+
+    connected = [count for count in counts if count >= 0]
+    print(f"viewers: {len(connected)}/{args.viewers} connected, "
+          f"messages per viewer min/avg {min(connected, default=0)}/{sum(connected) / max(len(connected), 1):.1f}")
+    print(f"{args.request_path}: {len(latencies)} ok, {errors} failed, "
+          f"p50 {percentile(latencies, 0.5):.1f} ms, p95 {percentile(latencies, 0.95):.1f} ms, "
+          f"max {max(latencies, default=float('nan')):.1f} ms")
+
+
+def synthetic_gallery(employees, templates, probes, noise, seed=0):
+    # Unit-norm identities (distinct people sit ~1.4 apart) plus noisy
+    # templates and probes around them (same person ~noise apart).
+    rng = np.random.default_rng(seed)
+    identities = rng.normal(size=(employees, 128))
+    identities /= np.linalg.norm(identities, axis=1, keepdims=True)
+    per_row = noise / np.sqrt(128)
+    encodings = np.repeat(identities, templates, axis=0) + rng.normal(scale=per_row, size=(employees * templates, 128))
+    employee_ids = [f"E{index:06d}" for index in range(employees) for _ in range(templates)]
+    truth = rng.integers(0, employees, size=probes)
+    probe_encodings = identities[truth] + rng.normal(scale=per_row, size=(probes, 128))
+    return encodings, employee_ids, probe_encodings, [f"E{index:06d}" for index in truth]
+
+
+def benchmark_gallery(args):
+    # Compares the old list-of-float64-arrays gallery with FaceMatcher at
+    # each storage precision on memory, match speed and agreement.
+    from app import FaceMatcher
+
+    encodings, employee_ids, probes, truth = synthetic_gallery(
+        args.employees, args.templates, args.probes, args.noise)
+    print(f"{args.employees} employees x {args.templates} templates, {args.probes} probes, rerank={args.rerank}")
+
+    # Baseline: what load_known_faces used to hold and how it used to match.
+    legacy = [np.array(row, dtype=np.float64) for row in encodings]
+    legacy_bytes = sys.getsizeof(legacy) + sum(sys.getsizeof(row) for row in legacy)
+    started = time.perf_counter()
+    exact = []
+    for probe in probes:
+        distances = np.linalg.norm(np.array(legacy) - probe, axis=1)
+        best = int(distances.argmin())
+        exact.append(employee_ids[best] if distances[best] <= args.tolerance else None)
+    legacy_ms = (time.perf_counter() - started) * 1000.0
+    print(f"{'gallery':<10}{'MB':>8}{'ms/batch':>10}{'top1':>8}{'agree':>8}{'max err':>9}")
+    print(f"{'list f64':<10}{legacy_bytes / 1e6:>8.2f}{legacy_ms:>10.1f}"
+          f"{np.mean([a == b for a, b in zip(exact, truth)]):>8.3f}{1.0:>8.3f}{0.0:>9.4f}")
+
+    reference = FaceMatcher(encodings, employee_ids, employee_ids, tolerance=args.tolerance)
+    reference_distances = reference.distances(probes)
+    for precision in args.precisions:
+        matcher = FaceMatcher(encodings, employee_ids, employee_ids, tolerance=args.tolerance,
+                              precision=precision, rerank=args.rerank)
+        matcher.match(probes[:1])  # warm-up
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            matches = matcher.match(probes)
+        ms_per_batch = (time.perf_counter() - started) * 1000.0 / args.repeat
+        found = [employee_id for _, employee_id, _ in matches]
+        error = np.abs(matcher.distances(probes) - reference_distances).max()
+        print(f"{precision:<10}{matcher.memory_bytes() / 1e6:>8.2f}{ms_per_batch:>10.1f}"
+              f"{np.mean([a == b for a, b in zip(found, truth)]):>8.3f}"
+              f"{np.mean([a == b for a, b in zip(found, exact)]):>8.3f}{error:>9.4f}")
+
+
+def benchmark_shards(args):
+    # Scatter-gather matching over 1..N shard processes against the same
+    # gallery matched in-process.
+    from app import FaceMatcher, MatchShardPool, ShardedFaceMatcher
+
+    encodings, employee_ids, probes, _ = synthetic_gallery(args.employees, 1, args.probes, args.noise)
+    local = FaceMatcher(encodings, employee_ids, employee_ids, precision=args.precision)
+    del encodings
+    print(f"{args.employees} employees ({args.precision}), {args.probes} probes per batch, top-{args.k}")
+
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        expected, _ = local.top_k(probes, args.k)
+    local_ms = (time.perf_counter() - started) * 1000.0 / args.repeat
+    print(f"{'shards':<8}{'ms/batch':>10}{'speedup':>9}{'agree':>8}")
+    print(f"{'local':<8}{local_ms:>10.1f}{1.0:>9.2f}{1.0:>8.3f}")
+
+    for shards in args.shards or sorted({1, 2, 4, os.cpu_count() or 1}):
+        shard_pool = MatchShardPool(processes=shards, min_employees=0, timeout=60.0)
+        matcher = ShardedFaceMatcher(local, shard_pool)
+        try:
+            matcher.top_k(probes, args.k)  # starts workers and publishes the gallery
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                indexes, _ = matcher.top_k(probes, args.k)
+            ms_per_batch = (time.perf_counter() - started) * 1000.0 / args.repeat
+        finally:
+            matcher.release()
+            shard_pool.shutdown()
+        fallbacks = shard_pool.get_stats()['fallbacks']
+        agree = np.mean(indexes[:, 0] == expected[:, 0])
+        print(f"{shards:<8}{ms_per_batch:>10.1f}{local_ms / ms_per_batch:>9.2f}{agree:>8.3f}"
+              + (f"  ({fallbacks} local fallbacks)" if fallbacks else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Face recognition pipeline benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fixture = subparsers.add_parser('fixture', help='Build an annotated detection fixture from portraits')
+    fixture.add_argument('--portraits', help='Directory of single-person photos (default: stored enrollment photos)')
+    fixture.add_argument('--db', default='attendance_system.db')
+    fixture.add_argument('--output', default='fixtures/detection')
+    fixture.add_argument('--frames', type=int, default=60)
+    fixture.add_argument('--width', type=int, default=1280)
+    fixture.add_argument('--height', type=int, default=720)
+    fixture.add_argument('--max-faces', type=int, default=4, help='Faces pasted per frame')
+    fixture.add_argument('--min-face', type=int, default=30, help='Smallest pasted face height in pixels')
+    fixture.add_argument('--max-face', type=int, default=240, help='Largest pasted face height in pixels')
+    fixture.add_argument('--seed', type=int, default=0)
+    fixture.set_defaults(func=build_detection_fixture)
+
+    detectors = subparsers.add_parser('detectors', help='Compare detector throughput and recall')
+    detectors.add_argument('--frames', default='fixtures/detection', help='Fixture directory with annotations.json')
+    detectors.add_argument('--detectors', nargs='+', default=['hog', 'cnn', 'haar', 'dnn'])
+    detectors.add_argument('--upsample', type=int, default=1)
+    detectors.add_argument('--iou', type=float, default=0.5, help='IoU needed to count a detection as a hit')
+    detectors.set_defaults(func=benchmark_detectors)
+
+    streams = subparsers.add_parser('streams', help='Load test concurrent stream viewers plus normal requests')
+    streams.add_argument('--url', default='http://localhost:5000')
+    streams.add_argument('--viewers', type=int, default=40)
+    streams.add_argument('--duration', type=float, default=30.0)
+    streams.add_argument('--stream-path', default='/video_feed?max_width=480&max_fps=5&quality=50')
+    streams.add_argument('--events-path', default='/recognition_events', help='Every other viewer uses this; empty to disable')
+    streams.add_argument('--request-path', default='/recognition_stats', help='Short request timed alongside the viewers')
+    streams.add_argument('--interval', type=float, default=0.2)
+    streams.set_defaults(func=benchmark_streams)
+
+    gallery = subparsers.add_parser('gallery', help='Compare gallery storage precisions on synthetic encodings')
+    gallery.add_argument('--employees', type=int, default=10000)
+    gallery.add_argument('--templates', type=int, default=1, help='Templates per employee')
+    gallery.add_argument('--probes', type=int, default=64, help='Faces matched per batch')
+    gallery.add_argument('--noise', type=float, default=0.4, help='Distance of templates and probes from their identity')
+    gallery.add_argument('--precisions', nargs='+', default=['float32', 'float16', 'int8'])
+    gallery.add_argument('--rerank', type=int, default=0, help='Exact float32 re-rank of the N closest employees')
+    gallery.add_argument('--tolerance', type=float, default=0.6)
+    gallery.add_argument('--repeat', type=int, default=10)
+    gallery.set_defaults(func=benchmark_gallery)
+
+    shards = subparsers.add_parser('shards', help='Scale sharded gallery matching across processes')
+    shards.add_argument('--employees', type=int, default=200000)
+    shards.add_argument('--probes', type=int, default=16, help='Faces matched per batch')
+    shards.add_argument('--noise', type=float, default=0.4)
+    shards.add_argument('--precision', default='float32', choices=['float32', 'float16', 'int8'])
+    shards.add_argument('--shards', type=int, nargs='+', help='Shard counts to try (default 1, 2, 4 and the core count)')
+    shards.add_argument('--k', type=int, default=5)
+    shards.add_argument('--repeat', type=int, default=20)
+    shards.set_defaults(func=benchmark_shards)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+# gunicorn.conf.py
+# Production server settings for the Face Recognition Attendance System
+#
+# One worker process owns the cameras and the in-memory gallery; threads let
+# long-lived MJPEG and SSE streams run alongside short requests. Keep
+# STREAM_MAX_CLIENTS (app.py) below the thread count so some threads are
+# always left for the dashboard, attendance and enrollment pages.
+
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+worker_class = 'gthread'
+workers = 1
+threads = int(os.environ.get('GUNICORN_THREADS', 64))
+
+# Streams never finish, so only the worker heartbeat is subject to this.
+timeout = 120
+graceful_timeout = 10
+keepalive = 5